@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010, 2011, 2015 GiMaRIS <info@gimaris.com>
+#
+#  This file is part of BioDen - A data normalizer and transponer for
+#  files containing taxon biomass/density data for ecotopes.
+#
+#  BioDen is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  BioDen is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import hashlib
+
+# The default maximum number of bytes used by a cache. A cached SQLite
+# store is about three times the size of its input file.
+DEFAULT_BUDGET = 8 * 1024 ** 3
+
+def file_digest(filename, block_size=1024*1024):
+    """Return the SHA-1 hex digest of the contents of file `filename`."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def make_key(*parts):
+    """Return a cache key for the parts `parts`. Each part is converted to
+    a string with :func:`repr`.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(repr(part))
+        digest.update('\0')
+    return digest.hexdigest()
+
+class Cache(object):
+    """A folder of cached files, which are looked up by key.
+
+    When the files in the cache use more than `budget` bytes, the least
+    recently used files are removed. A file which alone is larger than
+    `budget` isn't cached.
+    """
+
+    def __init__(self, folder, budget=DEFAULT_BUDGET):
+        self.folder = folder
+        self.budget = budget
+
+    def path(self, key):
+        """Return the path of the cache file for key `key`."""
+        return os.path.join(self.folder, key)
+
+    def get(self, key):
+        """Return the path of the cache file for key `key`, or None if the
+        key isn't cached.
+        """
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+
+        # Mark the file as recently used.
+        os.utime(path, None)
+        return path
+
+    def put(self, key, save, size=None):
+        """Add a file for key `key` to the cache. Function `save` is called
+        with the path to which the file must be saved. If the estimated
+        file size `size` is given and larger than the budget, the file
+        isn't saved at all.
+        """
+        if self.budget <= 0 or (size is not None and size > self.budget):
+            return
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        # Save to a temporary file first, so an unfinished file is never
+        # found by get().
+        path = self.path(key)
+        temp_path = path + '.tmp'
+
+        # Remove the temporary file of an earlier run that crashed, as
+        # the save function may not overwrite it.
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        try:
+            save(temp_path)
+
+            # A file that doesn't fit in the budget by itself would only
+            # evict all other files, and then itself.
+            if os.path.getsize(temp_path) > self.budget:
+                return
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.evict(path)
+
+    def evict(self, keep=None):
+        """Remove the least recently used files until the cache fits in the
+        budget. The file at path `keep` is never removed. Temporary files
+        left behind by runs that crashed are removed as well.
+        """
+        if not os.path.isdir(self.folder):
+            return
+
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if not os.path.isfile(path):
+                continue
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append( (stat.st_mtime, stat.st_size, path) )
+
+        # Remove the oldest files first.
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if path == keep:
+                continue
+            if total <= self.budget:
+                break
+            os.remove(path)
+            total -= size
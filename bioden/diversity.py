@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010, 2011, 2015 GiMaRIS <info@gimaris.com>
+#
+#  This file is part of BioDen - A data normalizer and transponer for
+#  files containing taxon biomass/density data for ecotopes.
+#
+#  BioDen is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  BioDen is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+# The names of the biodiversity indices.
+INDICES = ('richness', 'shannon', 'simpson')
+
+# The maximum number of records times replicates grouped at once by
+# :func:`resampled_diversities`.
+RESAMPLING_BATCH_SIZE = 4 * 1024 * 1024
+
+def diversity_indices(groups, sums, n):
+    """Return a dictionary which maps the name of each biodiversity index
+    to an array with the index of each group 0 to `n`-1.
+
+    Array `sums` holds the sums of the taxa in the groups, and array
+    `groups` holds the group of each sum. Only the taxa with a sum greater
+    than 0 are counted. The indices are:
+
+    richness
+        The number of taxa.
+    shannon
+        The Shannon index, ``-sum(p * ln(p))``, where ``p`` is the
+        proportion of each taxon in the total sum of the group.
+    simpson
+        The Gini-Simpson index, ``1 - sum(p ** 2)``.
+
+    Groups without taxa have an index of 0.
+    """
+    positive = sums > 0
+    groups = groups[positive]
+    sums = sums[positive]
+
+    richness = np.bincount(groups, minlength=n)
+    totals = np.bincount(groups, weights=sums, minlength=n)
+    proportions = sums / totals[groups]
+    shannon = 0.0 - np.bincount(groups,
+        weights=proportions * np.log(proportions), minlength=n)
+    simpson = np.where(richness > 0, 1.0 - np.bincount(groups,
+        weights=proportions ** 2, minlength=n), 0.0)
+
+    return {'richness': richness, 'shannon': shannon, 'simpson': simpson}
+
+def resampled_diversities(task):
+    """Return an array with the biodiversities of the sample groups made
+    from random orderings of the samples of an ecotope.
+
+    This function can be run by worker processes. Argument `task` is a
+    tuple ``(records, target, index, seed, ecotope_id, first, count)``.
+    The `records` of the ecotope are returned by the ``sample_records()``
+    method of the stores. For each of the `count` replicates starting at
+    replicate `first`, the samples are put in a random order and grouped
+    into groups with a sample surface of `target` or higher. Biodiversity
+    index `index` is calculated for each group.
+
+    The random order of each replicate only depends on `seed`,
+    `ecotope_id` and the replicate number, so the results don't depend on
+    how the replicates are divided over the tasks.
+    """
+    records, target, index, seed, ecotope_id, first, count = task
+    codes, surfaces, taxon_ids, values = records
+
+    # Number the samples and the taxa of the ecotope.
+    new_sample = np.concatenate(([True], codes[1:] != codes[:-1])) \
+        if len(codes) else np.zeros(0, dtype=bool)
+    samples = np.cumsum(new_sample) - 1
+    sample_surfaces = surfaces[new_sample]
+    n_samples = len(sample_surfaces)
+    taxa, taxon_ids = np.unique(taxon_ids, return_inverse=True)
+    n_taxa = len(taxa)
+
+    # The order of the samples in each replicate.
+    orders = np.array([np.random.RandomState([seed, ecotope_id,
+        replicate]).permutation(n_samples)
+        for replicate in range(first, first + count)],
+        dtype=np.int_).reshape(count, n_samples)
+
+    # Group the samples of all replicates at once, one position at a time.
+    # The samples of the last group that doesn't reach the target are
+    # left out.
+    position_groups = np.empty((count, n_samples), dtype=np.int_)
+    group_surfaces = np.zeros(count)
+    n_groups = np.zeros(count, dtype=np.int_)
+    for j in range(n_samples):
+        group_surfaces += sample_surfaces[orders[:,j]]
+        position_groups[:,j] = n_groups
+        finished = group_surfaces >= target
+        n_groups += finished
+        group_surfaces[finished] = 0.0
+    sample_groups = np.empty_like(position_groups)
+    sample_groups[np.arange(count)[:,None], orders] = position_groups
+
+    # Calculate the sums per group and taxon in batches of replicates.
+    width = int(n_groups.max()) + 1 if count else 1
+    diversities = []
+    step = max(1, RESAMPLING_BATCH_SIZE // max(1, len(codes)))
+    for start in range(0, count, step):
+        replicates = np.arange(start, min(start + step, count))
+        record_groups = sample_groups[replicates][:,samples]
+        keep = record_groups < n_groups[replicates][:,None]
+        groups = (replicates[:,None] * width + record_groups)[keep]
+        cells = groups.astype(np.int64) * n_taxa + \
+            np.broadcast_to(taxon_ids, keep.shape)[keep]
+        weights = np.broadcast_to(values, keep.shape)[keep]
+
+        # Sum the values per cell. Counting in an array with room for all
+        # cells is faster than sorting, if the array isn't too large.
+        size = len(replicates) * width * n_taxa
+        if size <= 2 * RESAMPLING_BATCH_SIZE:
+            sums = np.bincount(cells, weights=weights, minlength=size)
+            cells = np.flatnonzero(np.bincount(cells, minlength=size))
+            sums = sums[cells]
+        else:
+            cells, inverse = np.unique(cells, return_inverse=True)
+            sums = np.bincount(inverse, weights=weights)
+
+        # Number the groups of the cells, which are in order of group.
+        groups = cells // n_taxa
+        cell_groups = np.cumsum(np.concatenate(([True],
+            groups[1:] != groups[:-1]))) - 1 if len(groups) else groups
+        diversities.append(diversity_indices(cell_groups, sums,
+            cell_groups[-1] + 1 if len(groups) else 0)[index])
+
+    return np.concatenate(diversities) if diversities else np.zeros(0)
@@ -21,187 +21,250 @@
 
 import os
 import csv
-from sqlite3 import dbapi2 as sqlite
+import itertools
+import operator
+import collections
+import multiprocessing
+import Queue
 
 import xlwt
+import numpy as np
+
+# The maximum number of cells that are read from the store for ecotope
+# files which aren't written yet by the export worker processes.
+EXPORT_MAX_PENDING_CELLS = 4 * 1024 * 1024
+
+# The generator of an export worker process, set by init_export_worker().
+_worker_generator = None
+
+def init_export_worker(generator):
+    """Set the generator used by :func:`export_ecotope` in this worker
+    process.
+    """
+    global _worker_generator
+    _worker_generator = generator
+
+def export_ecotope(task):
+    """Write an ecotope file.
+
+    This function is run by worker processes. Argument `task` is a tuple
+    ``(output_file, method, args)``. The rows of `output_file` are made by
+    method `method` of the generator of the worker, with the arguments
+    `args` that were read from the store by the parent process.
+    """
+    output_file, method, args = task
+    _worker_generator.export(output_file,
+        getattr(_worker_generator, method)(*args))
 
 class Generator:
-    """Super class for Generator classes."""
+    """Super class for Generator classes.
 
-    def __init__(self, processor):
+    The generator exports the sample groups of target sample surface
+    `surface_id` of `processor`. If the processor has more than one target
+    sample surface, the names of the files with sample groups are tagged
+    with the surface.
+    """
+
+    def __init__(self, processor, surface_id=0):
         self.processor = processor
-        self._dbfile = processor._dbfile
+        self.store = processor.results
         self._property = processor._property
-        self._representative_groups = processor._representative_groups
+        self._surface_id = surface_id
+        self._representative_groups = \
+            processor._representative_groups[surface_id]
+        self._diversity_index = processor._diversity_index
+        self._replicates = processor._replicates
         self._do_round = processor._do_round
+        self._output_layout = processor._output_layout
         self._output_folder = processor._output_folder
         self._file_extension = ".txt"
         self.taxa = processor.taxa
         self.ecotopes = processor.ecotopes
+        self._sample_surfaces = None
 
-    def ecotope_data_grouped(self, ecotope, data_type='raw'):
-        """Return an iterator object which generates the CSV data of
-        grouped data for ecotope `ecotope`.
-        """
-        if data_type == 'raw':
-            target_table = 'sums_of'
-        elif data_type == 'normalized':
-            target_table = 'normalized_sums_of'
+        # The tag for the file names of this target sample surface.
+        if len(processor._target_sample_surfaces) > 1:
+            self._surface_tag = "_%s" % \
+                processor._target_sample_surfaces[surface_id]
         else:
+            self._surface_tag = ""
+
+    def __getstate__(self):
+        """Return the state of this generator for the export worker
+        processes. The processor and the store aren't passed, because the
+        workers only make and write the rows of the ecotope files.
+        """
+        state = self.__dict__.copy()
+        del state['processor'], state['store']
+        return state
+
+    def sample_surfaces(self):
+        """Return a dictionary which maps all sample codes to their sample
+        surface. The sample surfaces are read from the store once.
+        """
+        if self._sample_surfaces is None:
+            codes, surfaces = self.store.sample_surfaces()
+            self._sample_surfaces = dict(zip(codes.tolist(),
+                surfaces.tolist()))
+        return self._sample_surfaces
+
+    def taxon_rows(self, cells, columns, sparse=False):
+        """Return an iterator object which generates a data row for each
+        taxon from the iterable `cells`, which generates ``(taxon_id, key,
+        value)`` tuples ordered by taxon ID. Dictionary `columns` maps each
+        key to its column in the rows.
+
+        The rows for the taxa without cells are empty, or are left out if
+        `sparse` is True.
+        """
+        empty = [None] * len(columns)
+        next_taxon = 0
+        for taxon_id, taxon_cells in itertools.groupby(cells,
+                operator.itemgetter(0)):
+            # Return the rows of the taxa without cells before this one.
+            if not sparse:
+                for i in range(next_taxon, taxon_id):
+                    yield [self.taxa[i]] + empty
+            next_taxon = taxon_id + 1
+
+            row = [self.taxa[taxon_id]] + empty
+            for taxon_id, key, value in taxon_cells:
+                if isinstance(self._do_round, int):
+                    value = round(value, self._do_round)
+                row[columns[key]] = value
+            yield row
+
+        # Return the rows of the remaining taxa.
+        if not sparse:
+            for i in range(next_taxon, len(self.taxa)):
+                yield [self.taxa[i]] + empty
+
+    def ecotope_rows(self, cells, columns, name):
+        """Return an iterator object which generates the data rows of an
+        ecotope file in the layout set with
+        :meth:`bioden.processor.DataProcessor.set_output_layout`.
+
+        Arguments `cells` and `columns` are passed to :meth:`taxon_rows`.
+        In the long layout, the rows are ``(taxon, key, value)`` ordered by
+        taxon and column, after a header row where `name` is the name of
+        the keys.
+        """
+        if self._output_layout != 'long':
+            return self.taxon_rows(cells, columns,
+                self._output_layout == 'sparse')
+        return self.long_rows(cells, columns, name)
+
+    def long_rows(self, cells, columns, name):
+        """Return an iterator object which generates the data rows of an
+        ecotope file in the long layout. See :meth:`ecotope_rows`.
+        """
+        yield ['Taxon:', name, 'Value:']
+        column = lambda cell: columns[cell[1]]
+        for taxon_id, taxon_cells in itertools.groupby(cells,
+                operator.itemgetter(0)):
+            taxon = self.taxa[taxon_id]
+            for taxon_id, key, value in sorted(taxon_cells, key=column):
+                if isinstance(self._do_round, int):
+                    value = round(value, self._do_round)
+                yield [taxon, key, value]
+
+    def grouped_data(self, ecotope, data_type='raw'):
+        """Return the arguments of :meth:`grouped_rows` for the grouped
+        data of ecotope `ecotope`.
+
+        The sums are read from the store in a single scan, ordered by
+        taxon, so the number of queries doesn't depend on the number of
+        taxa and groups.
+        """
+        if data_type not in ('raw', 'normalized'):
             raise ValueError("Value for 'data' can be either 'raw' or 'normalized', not '%s'." % data_type)
 
-        # Connect to the database.
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
+        return (ecotope,
+            self.store.group_surfaces(data_type, ecotope, self._surface_id),
+            self.store.taxon_sums(data_type, ecotope, self._surface_id))
 
+    def grouped_rows(self, ecotope, groups, cells):
+        """Return an iterator object which generates the CSV data of
+        grouped data for ecotope `ecotope`. List `groups` contains the
+        ``(group_id, group_surface)`` tuples of the groups, and `cells` is
+        passed to :meth:`ecotope_rows`.
+        """
         yield ['Property:', self._property]
 
         # Return the first row containing the ecotope name.
         yield ['Ecotope:', ecotope]
 
-        # Get the number of groups for this ecotope.
-        cursor.execute("SELECT group_id \
-            FROM %s \
-            WHERE compiled_ecotope = ?" % target_table,
-            (ecotope,)
-            )
-        group_ids = []
-        for id in cursor:
-            if id[0] not in group_ids:
-                group_ids.append(id[0])
-        group_ids.sort()
-
         # Return third row containing the group numbers.
         row = ['Sample group:']
-        row.extend(group_ids)
+        row.extend(group_id for group_id, surface in groups)
         yield row
 
         # Return fourth row containing the group surfaces.
         row = ['Group surface:']
-        for group_id in group_ids:
-            cursor.execute("SELECT group_surface \
-                FROM %s \
-                WHERE compiled_ecotope = ? \
-                AND group_id = ?" % target_table,
-                (ecotope,group_id)
-                )
-            row.extend(cursor.fetchone())
+        row.extend(surface for group_id, surface in groups)
         yield row
 
         # Return an empty row.
         yield [None]
 
         # Return the data rows.
-        for taxon in self.taxa:
-            row = [taxon]
-
-            cursor.execute("SELECT group_id, sum_of \
-                FROM %s \
-                WHERE compiled_ecotope = ? \
-                AND standardised_taxon = ?" % (target_table),
-                (ecotope,taxon)
-                )
-            sums_of = dict(cursor)
-
-            for group_id in group_ids:
-                if group_id in sums_of:
-                    sum_of = sums_of[group_id]
-                    if isinstance(self._do_round, int):
-                        sum_of = round(sum_of, self._do_round)
-                    row.append(sum_of)
-                else:
-                    row.append(None)
-
+        columns = dict((group_id, i) for i, (group_id, surface) in
+            enumerate(groups, 1))
+        for row in self.ecotope_rows(cells, columns, 'Sample group:'):
             yield row
 
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
+    def raw_data(self, ecotope):
+        """Return the arguments of :meth:`raw_rows` for the non-grouped
+        data of ecotope `ecotope`.
 
-    def ecotope_data_raw(self, ecotope):
-        """Return an iterator object which generates the CSV data of
-        non-grouped data for ecotope `ecotope`.
+        The values are read from the store in a single scan, ordered by
+        taxon, so the number of queries doesn't depend on the number of
+        taxa and samples.
         """
-        if self._property == 'biomass':
-            select_field = 'sum_of_biomass'
-        else:
-            select_field = 'sum_of_density'
-
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
+        sample_surfaces = self.sample_surfaces()
+        samples = [(sample_code, sample_surfaces[sample_code]) for
+            sample_code in sorted(self.store.sample_codes(ecotope))]
+        return (ecotope, samples,
+            self.store.taxon_values(ecotope, self._property))
 
+    def raw_rows(self, ecotope, samples, cells):
+        """Return an iterator object which generates the CSV data of
+        non-grouped data for ecotope `ecotope`. List `samples` contains the
+        ``(sample_code, sample_surface)`` tuples of the samples, and `cells`
+        is passed to :meth:`ecotope_rows`.
+        """
         # Return the first row containing the property.
         yield ['Property:', self._property]
 
         # Return the second row containing the ecotope name.
         yield ['Ecotope:', ecotope]
 
-        # Get the record IDs for this ecotope.
-        cursor.execute("SELECT sample_code \
-            FROM data \
-            WHERE compiled_ecotope = ?",
-            (ecotope,)
-            )
-        sample_codes = []
-        for id in cursor:
-            if id[0] not in sample_codes:
-                sample_codes.append(id[0])
-        sample_codes.sort()
-
         # Return third row containing the sample codes.
         row = ['Sample code:']
-        row.extend(sample_codes)
+        row.extend(sample_code for sample_code, surface in samples)
         yield row
 
         # Return fourth row containing the sample surfaces.
         row = ['Sample surface:']
-        for sample_code in sample_codes:
-            cursor.execute("SELECT sample_surface \
-                FROM samples \
-                WHERE sample_code = ?",
-                (sample_code,)
-                )
-            sample_surface = cursor.fetchone()[0]
-            row.append(sample_surface)
+        row.extend(surface for sample_code, surface in samples)
         yield row
 
         # Return an empty row.
         yield [None]
 
         # Return the data rows.
-        for taxon in self.taxa:
-            row = [taxon]
-
-            cursor.execute("SELECT sample_code, %s \
-                FROM data \
-                WHERE compiled_ecotope = ? \
-                AND standardised_taxon = ?" % select_field,
-                (ecotope,taxon)
-                )
-            sums_of = dict(cursor)
-
-            for sample_code in sample_codes:
-                if sample_code in sums_of:
-                    sum_of = sums_of[sample_code]
-                    if isinstance(self._do_round, int):
-                        sum_of = round(sum_of, self._do_round)
-                    row.append(sum_of)
-                else:
-                    row.append(None)
-
+        columns = dict((sample_code, i) for i, (sample_code, surface) in
+            enumerate(samples, 1))
+        for row in self.ecotope_rows(cells, columns, 'Sample code:'):
             yield row
 
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
-
     def representatives(self):
         """Return an iterator object which generates the CSV data with
         only the representative group for each ecotope.
-        """
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
 
+        The sums of all representative groups are read from the store in
+        a single pass, ordered by taxon.
+        """
         yield ['Property:', self._property]
 
         # Return the first row containing the ecotopes.
@@ -210,113 +273,232 @@ class Generator:
             row.append(ecotope)
         yield row
 
-        # Return fourth row containing the group surfaces.
+        # The most representative group of each ecotope with groups.
+        groups = [(ecotope, self._representative_groups[ecotope]) for
+            ecotope in self.ecotopes if ecotope in self._representative_groups]
+
+        # Return fourth row containing the group surfaces. Append an empty
+        # field if the ecotope has no group.
+        surfaces = dict((ecotope, self.store.group_surface('normalized',
+            ecotope, group_id, self._surface_id)) for ecotope, group_id in
+            groups)
         row = ['Group surface:']
-        for ecotope in self.ecotopes:
-            # Append and empty field if the ecotope has no group.
-            if ecotope not in self._representative_groups:
-                row.append(None)
-                continue
-
-            # Get the most representative group for this ecotope.
-            group_id = self._representative_groups[ecotope]
-
-            # Get the group surfaces for this group.
-            cursor.execute("SELECT group_surface \
-                FROM normalized_sums_of \
-                WHERE compiled_ecotope = ? \
-                AND group_id = ?",
-                (ecotope,group_id)
-                )
-            row.extend(cursor.fetchone())
+        row.extend(surfaces.get(ecotope) for ecotope in self.ecotopes)
         yield row
 
         # Return an empty row.
         yield [None]
 
         # Return the data rows.
-        for taxon in self.taxa:
-            row = [taxon]
-            for ecotope in self.ecotopes:
-                # Append and empty field if the ecotope has no group.
-                if ecotope not in self._representative_groups:
-                    row.append(None)
-                    continue
+        columns = dict((ecotope, i) for i, ecotope in
+            enumerate(self.ecotopes, 1))
+        for row in self.taxon_rows(self.store.selected_group_sums(
+                'normalized', groups, self._surface_id), columns):
+            yield row
+
+    def diversity_distributions(self):
+        """Return an iterator object which generates the CSV data with
+        statistics of the biodiversities of the sample groups made from
+        random orderings of the samples, for each ecotope.
+        """
+        yield ['Property:', self._property]
+        yield ['Diversity index:', self._diversity_index]
+        yield ['Replicates:', self._replicates]
 
-                # Get the most representative group for this ecotope.
-                group_id = self._representative_groups[ecotope]
+        # Return an empty row.
+        yield [None]
+
+        # Return the row containing the ecotopes.
+        row = ['Ecotope:']
+        row.extend(self.ecotopes)
+        yield row
 
-                # Get the sum_of
-                cursor.execute("SELECT sum_of \
-                    FROM normalized_sums_of \
-                    WHERE group_id = ? \
-                    AND compiled_ecotope = ? \
-                    AND standardised_taxon = ?",
-                    (group_id,ecotope,taxon)
-                    )
+        # Return a row for each statistic.
+        statistics = (
+            ('Groups:', len),
+            ('Mean:', np.mean),
+            ('Standard deviation:', np.std),
+            ('Minimum:', np.min),
+            ('2.5th percentile:', lambda x: np.percentile(x, 2.5)),
+            ('Median:', np.median),
+            ('97.5th percentile:', lambda x: np.percentile(x, 97.5)),
+            ('Maximum:', np.max),
+        )
+        distributions = self.processor.diversity_distributions.get(
+            self._surface_id, {})
+        for name, statistic in statistics:
+            row = [name]
+            for ecotope in self.ecotopes:
+                diversities = distributions.get(ecotope)
 
-                density = cursor.fetchone()
-                if not density:
+                # Append an empty field if the ecotope has no groups.
+                if diversities is None or len(diversities) == 0:
                     row.append(None)
-                else:
-                    density = density[0]
-                    if isinstance(self._do_round, int):
-                        density = round(density, self._do_round)
-                    row.append(density)
-            yield row
+                    continue
 
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
+                value = statistic(diversities)
+                if isinstance(self._do_round, int) and statistic is not len:
+                    value = round(value, self._do_round)
+                row.append(float(value) if statistic is not len else value)
+            yield row
 
     def export_ecotopes_grouped(self, data_type='raw'):
-        """Return an iterator object which generates CSV data for all ecotopes.
-        For each ecotope, the grouped data is returned. If `data_type` is set
-        to "raw", the non-normalized group values are returned. If `data_type`
-        is set to "normalized", the normalized group values are returned.
+        """Export the grouped data of all ecotopes, one file per ecotope.
+        If `data_type` is set to "raw", the non-normalized group values are
+        exported. If `data_type` is set to "normalized", the normalized
+        group values are exported.
         """
-        for ecotope in self.ecotopes:
-            # Update progress dialog.
-            self.processor.pdialog_handler.increase()
+        self.export_ecotopes(self.grouped_task(ecotope, data_type) for
+            ecotope in self.ecotopes)
 
-            # Create a CSV generator.
-            data = self.ecotope_data_grouped(ecotope, data_type)
+    def grouped_task(self, ecotope, data_type='raw', groups=None):
+        """Return the task of :meth:`export_ecotopes` for the grouped data
+        of ecotope `ecotope`. The groups are read from the store, unless
+        the :class:`bioden.store.GroupMatrix` `groups` is given.
+        """
+        # Construct a filename.
+        if data_type == 'raw':
+            prefix = 'grouped'
+        elif data_type == 'normalized':
+            prefix = 'ambi'
+        else:
+            raise ValueError("Value for 'data' can be either 'raw' or 'normalized', not '%s'." % data_type)
 
-            # Construct a filename.
-            if data_type == 'raw':
-                prefix = 'grouped'
-            elif data_type == 'normalized':
-                prefix = 'ambi'
-            else:
-                raise ValueError("Value for 'data' can be either 'raw' or 'normalized', not '%s'." % data_type)
+        suffix = ecotope.replace(" ", "_")
+        filename = "%s_%s%s_%s%s" % (prefix, self._property, self._surface_tag, suffix, self._file_extension)
+        output_file = os.path.join(self._output_folder, filename)
 
-            suffix = ecotope.replace(" ", "_")
-            filename = "%s_%s_%s%s" % (prefix, self._property, suffix, self._file_extension)
-            output_file = os.path.join(self._output_folder, filename)
+        if groups is None:
+            data = self.grouped_data(ecotope, data_type)
+        else:
+            data = (ecotope, groups.group_surfaces(), groups.taxon_sums())
 
-            # Export data.
-            self.processor.pdialog_handler.add_details("Saving %s sample groups of ecotope '%s' to %s" % (data_type, ecotope, output_file))
-            self.export(output_file, data)
+        log = "Saving %s sample groups of ecotope '%s' to %s" % (data_type, ecotope, output_file)
+        return output_file, log, 'grouped_rows', data
 
     def export_ecotopes_raw(self):
-        """Return an iterator object which generates CSV data for all ecotopes.
-        For each ecotope, the non-grouped data is returned.
+        """Export the non-grouped data of all ecotopes, one file per
+        ecotope.
         """
-        for ecotope in self.ecotopes:
-            # Update progress dialog.
-            self.processor.pdialog_handler.increase()
+        self.export_ecotopes(self.raw_task(ecotope) for ecotope in
+            self.ecotopes)
+
+    def raw_task(self, ecotope):
+        """Return the task of :meth:`export_ecotopes` for the non-grouped
+        data of ecotope `ecotope`.
+        """
+        # Construct a filename.
+        suffix = ecotope.replace(" ", "_")
+        filename = "raw_%s_%s%s" % (self._property, suffix, self._file_extension)
+        output_file = os.path.join(self._output_folder, filename)
 
-            # Create a CSV generator.
-            data = self.ecotope_data_raw(ecotope)
+        log = "Saving raw data of ecotope '%s' to %s" % (ecotope, output_file)
+        return output_file, log, 'raw_rows', self.raw_data(ecotope)
 
-            # Construct a filename.
-            suffix = ecotope.replace(" ", "_")
-            filename = "raw_%s_%s%s" % (self._property, suffix, self._file_extension)
-            output_file = os.path.join(self._output_folder, filename)
+    def write_ecotope(self, task):
+        """Write the ecotope file of task `task` of :meth:`export_ecotopes`
+        in this thread.
+        """
+        output_file, log, method, args = task
+        self.processor.pdialog_handler.add_details(log)
+        self.export(output_file, getattr(self, method)(*args))
+
+    def export_ecotopes(self, tasks):
+        """Write the ecotope files for the iterable `tasks`, which generates
+        a tuple ``(output_file, log, method, args)`` for each ecotope. The
+        rows of `output_file` are made by method `method` with arguments
+        `args`, and `log` is added to the details of the progress dialog.
+
+        If more than one process is set with
+        :meth:`bioden.processor.DataProcessor.set_processes`, the files are
+        made and written by a pool of processes. Otherwise they are written
+        in this thread.
+        """
+        processes = self.processor._processes
+        if processes > 1 and len(self.ecotopes) > 1:
+            self.parallel_export(tasks, processes)
+            return
+
+        for task in tasks:
+            if self.processor.stopped():
+                break
+
+            # Update progress dialog.
+            self.processor.pdialog_handler.increase()
 
             # Export data.
-            self.processor.pdialog_handler.add_details("Saving raw data of ecotope '%s' to %s" % (ecotope, output_file))
-            self.export(output_file, data)
+            self.write_ecotope(task)
+
+    def parallel_export(self, tasks, processes):
+        """Write the ecotope files for the iterable `tasks` of
+        :meth:`export_ecotopes` with a pool of `processes` processes.
+
+        The arguments of each file are read from the store in this thread,
+        and the iterators among them are turned into lists for the worker
+        processes. A limited number of files is pending at once, and their
+        number of cells is limited to :data:`EXPORT_MAX_PENDING_CELLS`, so
+        the data of all ecotopes isn't held in memory at once. When the
+        export is stopped, the pending files are still written completely.
+        """
+        tasks = iter(tasks)
+
+        # The workers report written files through this queue.
+        finished = Queue.Queue()
+
+        pool = multiprocessing.Pool(processes, init_export_worker, (self,))
+        try:
+            running = {}
+            pending_cells = 0
+            exhausted = False
+            while (running or not exhausted) and \
+                    not self.processor.stopped():
+                # Read the data of the next ecotopes while there is room.
+                # A single file is always started, however large it is.
+                while not exhausted and len(running) < 2 * processes and \
+                        (not running or \
+                        pending_cells < EXPORT_MAX_PENDING_CELLS):
+                    try:
+                        output_file, log, method, args = next(tasks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    args = tuple(list(arg) if
+                        isinstance(arg, collections.Iterator) else arg
+                        for arg in args)
+                    cells = sum(len(arg) for arg in args if
+                        isinstance(arg, list))
+                    pending_cells += cells
+                    result = pool.apply_async(export_ecotope,
+                        ((output_file, method, args),),
+                        callback=lambda written, output_file=output_file:
+                            finished.put(output_file))
+                    running[output_file] = (result, cells, log)
+
+                # Wait for a file to be written. A failed file doesn't
+                # call the callback, so its error is raised here.
+                try:
+                    output_file = finished.get(timeout=0.1)
+                except Queue.Empty:
+                    for result, cells, log in running.itervalues():
+                        if result.ready():
+                            result.get()
+                    continue
+                result, cells, log = running.pop(output_file)
+                result.get()
+                pending_cells -= cells
+
+                # Update progress dialog.
+                self.processor.pdialog_handler.increase()
+                self.processor.pdialog_handler.add_details(log)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+
+        # Let the workers finish the files they are writing, also when the
+        # export was stopped, so no truncated files are left behind.
+        pool.close()
+        pool.join()
 
     def export_representatives(self):
         """Return an iterator object which generates CSV data for all ecotopes.
@@ -325,18 +507,32 @@ class Generator:
         # Create a CSV generator.
         data = self.representatives()
 
-        filename = "representatives_%s%s" % (self._property, self._file_extension)
+        filename = "representatives_%s%s%s" % (self._property, self._surface_tag, self._file_extension)
         output_file = os.path.join(self._output_folder, filename)
 
         # Export data.
         self.processor.pdialog_handler.add_details("Saving representative sample groups to %s" % (output_file))
         self.export(output_file, data)
 
+    def export_diversity_distributions(self):
+        """Return an iterator object which generates CSV data with the
+        statistics of the resampled biodiversities for all ecotopes.
+        """
+        # Create a CSV generator.
+        data = self.diversity_distributions()
+
+        filename = "diversities_%s%s%s" % (self._property, self._surface_tag, self._file_extension)
+        output_file = os.path.join(self._output_folder, filename)
+
+        # Export data.
+        self.processor.pdialog_handler.add_details("Saving biodiversity distributions to %s" % (output_file))
+        self.export(output_file, data)
+
 class CSVExporter(Generator):
     """Export data in CSV format."""
 
-    def __init__(self, processor):
-        Generator.__init__(self, processor)
+    def __init__(self, processor, surface_id=0):
+        Generator.__init__(self, processor, surface_id)
         self._file_extension = ".csv"
 
     def export(self, output_file, data):
@@ -351,8 +547,8 @@ class CSVExporter(Generator):
 class XLSExporter(Generator):
     """Export data in XLS format."""
 
-    def __init__(self, processor):
-        Generator.__init__(self, processor)
+    def __init__(self, processor, surface_id=0):
+        Generator.__init__(self, processor, surface_id)
         self._file_extension = ".xls"
 
     def export(self, output_file, data):
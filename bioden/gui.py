@@ -24,6 +24,7 @@ import os
 import threading
 import webbrowser
 import csv
+import multiprocessing
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -32,6 +33,7 @@ from gi.repository import GObject
 
 from bioden import __copyright__, __version__, resource_filename
 import bioden.std
+import bioden.cache
 import bioden.processor
 
 USER_MANUAL_URL = "http://bioden.readthedocs.org/en/latest/user_manual.html"
@@ -117,9 +119,16 @@ class MainWindow(object):
         self.filefilter_xsl.add_mime_type("application/vnd.ms-excel")
         self.filefilter_xsl.add_pattern("*.xls")
 
+        # Create a XLSX filter for file choosers.
+        self.filefilter_xlsx = Gtk.FileFilter()
+        self.filefilter_xlsx.set_name("Microsoft Excel 2007 and later (.xlsx)")
+        self.filefilter_xlsx.add_mime_type("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        self.filefilter_xlsx.add_pattern("*.xlsx")
+
         # Add filters to the file chooser.
         self.chooser_input_file = self.builder.get_object('chooser_input_file')
         self.chooser_input_file.add_filter(self.filefilter_xsl)
+        self.chooser_input_file.add_filter(self.filefilter_xlsx)
         self.chooser_input_file.add_filter(self.filefilter_csv)
 
         # Set the default folder for the output folder to the user's
@@ -130,6 +139,14 @@ class MainWindow(object):
         # Set the default value for the 'round' spinbutton.
         self.builder.get_object('adjustment_round').set_value(-1)
 
+        # Use all CPUs by default.
+        self.builder.get_object('adjustment_processes').set_value(
+            multiprocessing.cpu_count())
+
+        # Set the default size of the cache in GB.
+        self.builder.get_object('adjustment_cache_size').set_value(
+            bioden.cache.DEFAULT_BUDGET / 1024 ** 3)
+
     def on_combobox_output_format_changed(self, combobox, data=None):
         """Show/hide the Excel limitation message."""
         active = combobox.get_active()
@@ -139,6 +156,11 @@ class MainWindow(object):
         else:
             self.builder.get_object('frame_warning').hide()
 
+    def on_checkbutton_cache_toggled(self, checkbutton, data=None):
+        """Enable/disable the cache size spinbutton."""
+        self.builder.get_object('spinbutton_cache_size').set_sensitive(
+            checkbutton.get_active())
+
     def on_window_destroy(self, widget, data=None):
         """Close the application."""
         Gtk.main_quit()
@@ -160,8 +182,17 @@ class MainWindow(object):
         property_ = self.combobox_property.get_active_text()
         active = self.combobox_output_format.get_active()
         output_format = self.combobox_output_format.get_active_text()
-        target_sample_surface = float(self.builder.get_object('entry_sample_surface').get_text())
+        surfaces = self.builder.get_object('entry_sample_surface').get_text()
         decimals = int(self.builder.get_object('spinbutton_round').get_value())
+        processes = int(self.builder.get_object('spinbutton_processes').get_value())
+        storage = self.builder.get_object('combobox_storage').get_active_id()
+        engine = self.builder.get_object('combobox_engine').get_active_id()
+        output_layout = self.builder.get_object('combobox_output_layout').get_active_id()
+        diversity_index = self.builder.get_object('combobox_diversity_index').get_active_id()
+        replicates = int(self.builder.get_object('spinbutton_replicates').get_value())
+        cache_size = 0
+        if self.builder.get_object('checkbutton_cache').get_active():
+            cache_size = int(self.builder.get_object('spinbutton_cache_size').get_value())
 
         # Normalize the output format name.
         if '.csv' in output_format:
@@ -169,29 +200,58 @@ class MainWindow(object):
         elif '.xls' in output_format:
             output_format = 'xls'
 
+        # The target sample surface can be a comma separated list of
+        # surfaces, which are all processed in a single run.
+        try:
+            target_sample_surfaces = [float(surface) for surface in
+                surfaces.split(',')]
+        except ValueError:
+            self.show_message(title="Invalid target sample surface",
+                message="The target sample surface must be a number, or a "
+                    "comma separated list of numbers (e.g. 0.1, 0.2).",
+                type=Gtk.MessageType.ERROR)
+            return
+
         # Get the name of the selected file type.
         self.filter_name = self.builder.get_object('chooser_input_file').get_filter().get_name()
 
-        # Show the progress dialog.
-        self.progress_dialog = ProgressDialog(parent=self.window)
-
         # Set up the data processor.
         if ".csv" in self.filter_name:
             self.worker = bioden.processor.CSVProcessor()
             self.worker.set_csv_dialect(delimiter, quotechar)
             self.worker.set_input_file(input_file, 'csv')
+        elif ".xlsx" in self.filter_name:
+            self.worker = bioden.processor.XLSXProcessor()
+            self.worker.set_input_file(input_file, 'xlsx')
         elif ".xls" in self.filter_name:
             self.worker = bioden.processor.XLSProcessor()
             self.worker.set_input_file(input_file, 'xls')
-        self.worker.set_property(property_)
+        if property_ == 'both':
+            # Load the data once, and make the results for both properties.
+            self.worker.set_property(['density', 'biomass'])
+        else:
+            self.worker.set_property(property_)
         self.worker.set_output_folder(output_folder)
-        self.worker.set_progress_dialog(self.progress_dialog)
-        self.worker.set_target_sample_surface(target_sample_surface)
+        try:
+            self.worker.set_target_sample_surface(target_sample_surfaces)
+        except ValueError as e:
+            self.show_message(title="Invalid target sample surface",
+                message=str(e), type=Gtk.MessageType.ERROR)
+            return
         self.worker.set_output_format(output_format)
+        self.worker.set_output_layout(output_layout)
         if decimals >= 0:
             self.worker.set_round(decimals)
-
-        # Pass the worker to the progress dialog.
+        self.worker.set_processes(processes)
+        self.worker.set_storage(storage)
+        self.worker.set_engine(engine)
+        self.worker.set_cache_budget(cache_size * 1024 ** 3)
+        self.worker.set_diversity_index(diversity_index)
+        self.worker.set_resampling(replicates)
+
+        # Show the progress dialog, and pass the worker to it.
+        self.progress_dialog = ProgressDialog(parent=self.window)
+        self.worker.set_progress_dialog(self.progress_dialog)
         self.progress_dialog.set_worker(self.worker)
 
         # Start processing the data.
@@ -220,6 +280,11 @@ class MainWindow(object):
                 "the settings under \"CSV Input File Options\" accordingly "
                 "and make sure the format matches the format described in the "
                 "documentation.")
+        elif ".xlsx" in self.filter_name:
+            message = ("The data could not be loaded. This is probably caused "
+                "by an incorrect input file or the XLSX file was in a different "
+                "format. Make sure the format matches the format described in "
+                "the documentation.")
         elif ".xls" in self.filter_name:
             message = ("The data could not be loaded. This is probably caused "
                 "by an incorrect input file or the XLS file was in a different "
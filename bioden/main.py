@@ -22,6 +22,7 @@
 import sys
 import os
 import warnings
+import multiprocessing
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -45,4 +46,8 @@ def main():
     sys.exit()
 
 if __name__ == '__main__':
+    # The data processor starts pools of processes. In the executable
+    # created with py2exe, the child processes run this script, and must
+    # not start the GUI.
+    multiprocessing.freeze_support()
     main()
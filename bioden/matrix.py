@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010, 2011, 2015 GiMaRIS <info@gimaris.com>
+#
+#  This file is part of BioDen - A data normalizer and transponer for
+#  files containing taxon biomass/density data for ecotopes.
+#
+#  BioDen is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  BioDen is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+
+import numpy as np
+
+import bioden.store
+
+def assign_groups(surfaces, target):
+    """Assign samples with the sample surfaces in array `surfaces` to
+    sample groups, in order. Return a tuple ``(sample_groups,
+    group_surfaces)`` with the group index of each sample and the list of
+    group surfaces.
+
+    A group surface is the sum of all sample surfaces that makes up the
+    group. When a group reached a group surface of `target` or higher, a
+    new group is started. Note that this means that the last group may not
+    reach `target`. Its samples get the group index ``len(group_surfaces)``.
+    """
+    group_surfaces = []
+    group_surface = 0.0
+    sample_groups = np.empty(len(surfaces), dtype=np.int_)
+    for i, sample_surface in enumerate(surfaces.tolist()):
+        group_surface += sample_surface
+        sample_groups[i] = len(group_surfaces)
+        if group_surface >= target:
+            group_surfaces.append(group_surface)
+            group_surface = 0.0
+    return sample_groups, group_surfaces
+
+class SparseMatrix(object):
+    """A sparse matrix with shape `shape` in compressed sparse row format.
+
+    The stored values of row `i` are ``values[indptr[i]:indptr[i+1]]``, in
+    the columns ``indices[indptr[i]:indptr[i+1]]``, sorted by column. A
+    stored value of 0 is different from no value.
+    """
+
+    def __init__(self, shape, indptr, indices, values):
+        self.shape = shape
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+
+        # The stored values sorted by column, made on first use by
+        # :meth:`column_range`.
+        self._by_column = None
+        self._sorted_columns = None
+
+    @classmethod
+    def from_coordinates(cls, shape, rows, columns, values):
+        """Return a matrix with shape `shape` with the values of array
+        `values` at the coordinates in arrays `rows` and `columns`. Values
+        with the same coordinates are summed in the order in which they
+        appear.
+        """
+        n_rows, n_columns = shape
+        keys, inverse = np.unique(rows.astype(np.int64) * n_columns +
+            columns, return_inverse=True)
+        sums = np.bincount(inverse, weights=values, minlength=len(keys))
+        rows, columns = np.divmod(keys, n_columns)
+        indptr = np.searchsorted(rows, np.arange(n_rows + 1))
+        return cls(shape, indptr, columns, sums)
+
+    def column_range(self, start, end):
+        """Return the rows, the columns and the values stored in the
+        columns `start` up to `end` as a tuple of arrays, ordered by row
+        and column.
+        """
+        if self._by_column is None:
+            self._by_column = np.argsort(self.indices, kind='mergesort')
+            self._sorted_columns = self.indices[self._by_column]
+        a = np.searchsorted(self._sorted_columns, start)
+        b = np.searchsorted(self._sorted_columns, end)
+
+        # The stored values are in order of row and column.
+        index = np.sort(self._by_column[a:b])
+        rows = np.searchsorted(self.indptr, index, side='right') - 1
+        return rows, self.indices[index], self.values[index]
+
+    def dot(self, columns, targets, n_columns):
+        """Return the product of this matrix with a matrix of ones and
+        zeros with `n_columns` columns. The ones are at the rows in array
+        `columns` and the columns in array `targets`.
+
+        So each column of this matrix is added to the columns of the
+        result it is assigned to. The values are added in order of column.
+        """
+        order = np.argsort(columns, kind='mergesort')
+        columns = columns[order]
+        targets = targets[order]
+
+        # Find the targets for each stored value.
+        starts = np.searchsorted(columns, self.indices, side='left')
+        counts = np.searchsorted(columns, self.indices, side='right') - starts
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + \
+            np.arange(counts.sum())
+
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return SparseMatrix.from_coordinates((self.shape[0], n_columns),
+            np.repeat(rows, counts), targets[offsets],
+            np.repeat(self.values, counts))
+
+    def scale(self, factors):
+        """Return a copy of the matrix where each column is multiplied by
+        its factor in array `factors`.
+        """
+        return SparseMatrix(self.shape, self.indptr, self.indices,
+            self.values * factors[self.indices])
+
+    def column_counts(self):
+        """Return an array with the number of stored values in each
+        column.
+        """
+        return np.bincount(self.indices, minlength=self.shape[1])
+
+class MatrixEngine(object):
+    """Compute the sample groups of all ecotopes for property `property`
+    with sparse matrices, from the data in store `store`.
+
+    The data is held in a taxon by sample matrix. For each target sample
+    surface in list `target_sample_surfaces`, grouping is the product with
+    a matrix that assigns the samples to the groups of their ecotopes, and
+    normalization scales each group to the target surface. The target
+    surfaces are referred to by their index in the list.
+
+    The engine answers the same queries as the stores in
+    :mod:`bioden.store`, so the generators of :mod:`bioden.exporter` can
+    read the results from it.
+    """
+
+    def __init__(self, store, property, target_sample_surfaces):
+        self._property = property
+        self._taxon_ids = dict((taxon, i) for i, taxon in
+            enumerate(store.taxa()))
+        self._ecotope_ids = dict((ecotope, i) for i, ecotope in
+            enumerate(store.ecotopes()))
+        n_taxa = len(self._taxon_ids)
+        n_ecotopes = len(self._ecotope_ids)
+
+        codes, ecotope_ids, taxon_ids, values = store.records(property)
+        sample_codes, sample_surfaces = store.sample_surfaces()
+        self._sample_surfaces = dict(zip(sample_codes.tolist(),
+            sample_surfaces.tolist()))
+
+        # Number the samples in order of sample code.
+        self._codes = np.unique(codes)
+        samples = np.searchsorted(self._codes, codes)
+        n_samples = len(self._codes)
+        surfaces = np.array([self._sample_surfaces[code] for code in
+            self._codes.tolist()], dtype=float)
+
+        # The samples of each ecotope, ordered by ecotope and sample code.
+        keys, members = np.unique(ecotope_ids.astype(np.int64) * n_samples +
+            samples, return_inverse=True)
+        member_ecotopes, self._member_samples = np.divmod(keys, n_samples)
+        self._member_ptr = np.searchsorted(member_ecotopes,
+            np.arange(n_ecotopes + 1))
+
+        # The non-grouped data of each ecotope has a column for each sample
+        # of the ecotope.
+        self._raw = SparseMatrix.from_coordinates((n_taxa, len(keys)),
+            taxon_ids, members, values)
+
+        # Group the taxon by sample matrix for each target surface.
+        data = SparseMatrix.from_coordinates((n_taxa, n_samples), taxon_ids,
+            samples, values)
+        self._groups = []
+        self._group_surfaces = []
+        self._group_ptr = []
+        self._group_sizes = []
+        for target in target_sample_surfaces:
+            self._make_groups(data, surfaces, target)
+        self._diversities = {}
+
+    def _make_groups(self, data, surfaces, target):
+        """Make the raw and the normalized groups of all ecotopes for target
+        sample surface `target` from taxon by sample matrix `data`, where
+        array `surfaces` holds the sample surfaces.
+        """
+        # Assign the samples of each ecotope to the groups of the ecotope.
+        # The groups of all ecotopes are numbered one after the other.
+        member_groups = np.empty(len(self._member_samples), dtype=np.int_)
+        group_surfaces = []
+        group_ptr = [0]
+        for ecotope_id in range(len(self._member_ptr) - 1):
+            start, end = self._member_ptr[ecotope_id:ecotope_id+2]
+            sample_groups, ecotope_surfaces = assign_groups(
+                surfaces[self._member_samples[start:end]], target)
+
+            # The samples of the unfinished group are left out.
+            sample_groups[sample_groups == len(ecotope_surfaces)] = -1
+            sample_groups[sample_groups >= 0] += len(group_surfaces)
+            member_groups[start:end] = sample_groups
+            group_surfaces.extend(ecotope_surfaces)
+            group_ptr.append(len(group_surfaces))
+
+        # Group the data, and normalize the groups.
+        keep = member_groups >= 0
+        grouped = data.dot(self._member_samples[keep], member_groups[keep],
+            len(group_surfaces))
+        group_surfaces = np.array(group_surfaces, dtype=float)
+        self._groups.append({
+            'raw': grouped,
+            'normalized': grouped.scale(target / group_surfaces),
+        })
+        self._group_surfaces.append({
+            'raw': group_surfaces,
+            'normalized': np.full(len(group_surfaces), target),
+        })
+        self._group_ptr.append(group_ptr)
+        self._group_sizes.append(grouped.column_counts())
+
+    def _check_property(self, property):
+        """Raise ValueError if property `property` is not computed."""
+        if property != self._property:
+            raise ValueError("The matrices hold property '%s', not '%s'." %
+                (self._property, property))
+
+    def _group_range(self, ecotope, surface_id):
+        """Return the first and the last plus one column of the groups of
+        ecotope `ecotope` for target surface `surface_id`.
+        """
+        ecotope_id = self._ecotope_ids[ecotope]
+        group_ptr = self._group_ptr[surface_id]
+        return group_ptr[ecotope_id], group_ptr[ecotope_id+1]
+
+    def sample_codes(self, ecotope):
+        """Return the sorted list of sample codes for ecotope `ecotope`."""
+        if ecotope not in self._ecotope_ids:
+            return []
+        ecotope_id = self._ecotope_ids[ecotope]
+        start, end = self._member_ptr[ecotope_id:ecotope_id+2]
+        return self._codes[self._member_samples[start:end]].tolist()
+
+    def sample_surfaces(self):
+        """Return the sample codes and the sample surfaces of all samples
+        as a tuple of arrays ``(sample_codes, sample_surfaces)``.
+        """
+        return (np.array(self._sample_surfaces.keys(), dtype=np.int_),
+            np.array(self._sample_surfaces.values(), dtype=float))
+
+    def taxon_values(self, ecotope, property):
+        """Return an iterator which generates a tuple ``(taxon_id,
+        sample_code, value)`` with the value of property `property` for
+        each record of ecotope `ecotope`, ordered by taxon ID.
+        """
+        self._check_property(property)
+        if ecotope not in self._ecotope_ids:
+            return iter([])
+        ecotope_id = self._ecotope_ids[ecotope]
+        start, end = self._member_ptr[ecotope_id:ecotope_id+2]
+        taxon_ids, members, values = self._raw.column_range(start, end)
+        return itertools.izip(taxon_ids.tolist(),
+            self._codes[self._member_samples[members]].tolist(),
+            values.tolist())
+
+    def group_surface(self, data_type, ecotope, group_id, surface_id=0):
+        """Return the surface of group `group_id` of ecotope `ecotope`."""
+        start, end = self._group_range(ecotope, surface_id)
+        return float(self._group_surfaces[surface_id][data_type][start +
+            group_id - 1])
+
+    def group_surfaces(self, data_type, ecotope, surface_id=0):
+        """Return the list of ``(group_id, group_surface)`` tuples for the
+        groups of ecotope `ecotope`, ordered by group ID.
+        """
+        if ecotope not in self._ecotope_ids:
+            return []
+        start, end = self._group_range(ecotope, surface_id)
+        columns = start + np.flatnonzero(
+            self._group_sizes[surface_id][start:end])
+        return zip((columns - start + 1).tolist(),
+            self._group_surfaces[surface_id][data_type][columns].tolist())
+
+    def taxon_sums(self, data_type, ecotope, surface_id=0):
+        """Return an iterator which generates a tuple ``(taxon_id,
+        group_id, sum)`` for each taxon in each group of ecotope `ecotope`,
+        ordered by taxon ID.
+        """
+        if ecotope not in self._ecotope_ids:
+            return iter([])
+        start, end = self._group_range(ecotope, surface_id)
+        taxon_ids, columns, sums = \
+            self._groups[surface_id][data_type].column_range(start, end)
+        return itertools.izip(taxon_ids.tolist(),
+            (columns - start + 1).tolist(), sums.tolist())
+
+    def selected_group_sums(self, data_type, groups, surface_id=0):
+        """Return an iterator which generates a tuple ``(taxon_id, ecotope,
+        sum)`` for each taxon in the groups of the list of ``(ecotope,
+        group_id)`` tuples `groups`, ordered by taxon ID.
+        """
+        matrix = self._groups[surface_id][data_type]
+        cells = []
+        for ecotope, group_id in groups:
+            if ecotope not in self._ecotope_ids:
+                continue
+            column = self._group_range(ecotope, surface_id)[0] + group_id - 1
+            rows, columns, sums = matrix.column_range(column, column + 1)
+            cells.append((ecotope, rows, sums))
+        return bioden.store.selected_sums(cells)
+
+    def group_cells(self, data_type, surface_id=0):
+        """Return the sums of all taxa in all groups as a tuple of arrays
+        ``(ecotope_ids, group_ids, sums)``.
+        """
+        groups = self._groups[surface_id][data_type]
+        group_ptr = np.asarray(self._group_ptr[surface_id])
+        columns = groups.indices
+        ecotope_ids = np.searchsorted(group_ptr, columns, side='right') - 1
+        group_ids = columns - group_ptr[ecotope_ids] + 1
+        return ecotope_ids.astype(np.intc), group_ids, groups.values
+
+    def commit(self):
+        """Do nothing, as there are no transactions."""
+        pass
+
+    def insert_diversities(self, ecotope, diversities, surface_id=0):
+        """Save the list of ``(group_id, diversity)`` tuples `diversities`
+        for ecotope `ecotope`.
+        """
+        self._diversities.setdefault((surface_id, ecotope),
+            []).extend(diversities)
+
+    def diversities(self, ecotope, surface_id=0):
+        """Return the list of ``(diversity, group_id)`` tuples for ecotope
+        `ecotope`.
+        """
+        return [(diversity, group_id) for group_id, diversity in
+            self._diversities.get((surface_id, ecotope), [])]
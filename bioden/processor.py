@@ -21,17 +21,186 @@
 
 import sys
 import os
-import time
 import threading
-from sqlite3 import dbapi2 as sqlite
+import itertools
+import operator
+import mmap
+import multiprocessing
 import csv
+import collections
+import Queue
 
 from appdirs import user_data_dir
+import numpy as np
 from gi.repository import GObject
 import xlrd
+import openpyxl
+from openpyxl.utils import get_column_letter
 
+import bioden
 import bioden.std
+import bioden.cache
 import bioden.exporter
+import bioden.store
+import bioden.matrix
+import bioden.stream
+import bioden.diversity
+
+# The names of the required fields in the input file.
+FIELDS = ('sample code', 'compiled ecotope', 'standardised taxon', 'density',
+    'biomass', 'sample surface')
+
+# The type of the reader objects returned by csv.reader().
+CSV_READER_TYPE = type(csv.reader([]))
+
+# CSV files smaller than this number of bytes are always parsed serially.
+PARALLEL_MIN_FILE_SIZE = 32 * 1024 * 1024
+
+# The approximate number of bytes of CSV data parsed by a process at once.
+PARALLEL_CHUNK_SIZE = 8 * 1024 * 1024
+
+def csv_records(reader, fields, properties):
+    """Return an iterator which generates the records from CSV reader
+    `reader`, where `fields` maps the required field names to column
+    indexes and `properties` is the list of selected properties. The
+    values of the other property are None. Blank lines are skipped.
+    """
+    to_float = bioden.std.to_float
+
+    # Both properties are extracted in the same pass over the rows.
+    if len(properties) > 1:
+        columns = operator.itemgetter(fields['sample code'],
+            fields['compiled ecotope'], fields['standardised taxon'],
+            fields['density'], fields['biomass'], fields['sample surface'])
+        for row in reader:
+            # Skip blank lines, like csv.DictReader does.
+            if not row:
+                continue
+            sample_code, ecotope, taxon, density, biomass, surface = \
+                columns(row)
+            yield (int(sample_code), ecotope.lower(), taxon,
+                to_float(density), to_float(biomass), surface)
+        return
+
+    # Get the columns we need from a row in one go.
+    property = properties[0]
+    columns = operator.itemgetter(fields['sample code'],
+        fields['compiled ecotope'], fields['standardised taxon'],
+        fields[property], fields['sample surface'])
+
+    # The extractor is specialised for the selected property, so we don't
+    # need to check the property for every row.
+    if property == 'density':
+        for row in reader:
+            if not row:
+                continue
+            sample_code, ecotope, taxon, value, surface = columns(row)
+            yield (int(sample_code), ecotope.lower(), taxon,
+                to_float(value), None, surface)
+    elif property == 'biomass':
+        for row in reader:
+            if not row:
+                continue
+            sample_code, ecotope, taxon, value, surface = columns(row)
+            yield (int(sample_code), ecotope.lower(), taxon,
+                None, to_float(value), surface)
+
+def find_record_end(data, start, pos, quotechar):
+    """Return the offset just past the end of the CSV record in `data`
+    that contains offset `pos`. Offset `start` must be the start of a
+    record at or before `pos`.
+
+    Newlines within quoted fields are skipped by keeping track of the
+    number of quote characters since `start`. Escaped quotes ("") don't
+    change this number's parity.
+    """
+    size = len(data)
+    quotes = data[start:pos].count(quotechar) if quotechar else 0
+    end = pos
+    while end < size:
+        newline = data.find('\n', end)
+        if newline == -1:
+            break
+        if quotechar:
+            quotes += data[end:newline].count(quotechar)
+        end = newline + 1
+        if quotes % 2 == 0:
+            return end
+    return size
+
+def parse_csv_chunk(task):
+    """Return the list of records in a chunk of a CSV file.
+
+    This function is run by worker processes. Argument `task` is a tuple
+    ``(filename, start, end, delimiter, quotechar, fields, properties)``,
+    where `start` and `end` are byte offsets on record boundaries. The
+    records of the chunk for the same sample, ecotope and taxon are
+    already summed, so less data is sent back to the parent process.
+    """
+    filename, start, end, delimiter, quotechar, fields, properties = task
+
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunk = data[start:end]
+        finally:
+            data.close()
+
+    # The dialect is passed explicitly, because worker processes don't
+    # share the parent's csv.excel settings on all platforms.
+    reader = csv.reader(chunk.splitlines(True), dialect=csv.excel,
+        delimiter=delimiter, quotechar=quotechar)
+    return bioden.store.aggregate(csv_records(reader, fields, properties))
+
+def group_records(records, target):
+    """Return the sample groups with a sample surface of `target` or higher
+    for the records `records`, as returned by the ``sample_records()``
+    method of the stores.
+
+    The samples are added to the groups in order of sample code. The
+    groups are returned as a :class:`bioden.store.GroupMatrix`.
+    """
+    codes, surfaces, taxon_ids, values = records
+
+    # The index of the first record of each sample.
+    starts = np.flatnonzero(np.concatenate(([True],
+        codes[1:] != codes[:-1]))) if len(codes) else np.zeros(0, int)
+
+    # Assign each sample to a group. Note that if the last group doesn't
+    # reach `target`, it won't be processed.
+    sample_groups, group_surfaces = bioden.matrix.assign_groups(
+        surfaces[starts], target)
+
+    # Calculate the sums per taxon and group in bulk, skipping the
+    # records of the unfinished group.
+    n_groups = len(group_surfaces)
+    record_groups = np.repeat(sample_groups,
+        np.diff(np.append(starts, len(codes))))
+    keep = record_groups < n_groups
+    rows, inverse = np.unique(taxon_ids[keep], return_inverse=True)
+    cells = inverse * n_groups + record_groups[keep]
+    size = len(rows) * n_groups
+    sums = np.bincount(cells, weights=values[keep], minlength=size)
+    present = np.bincount(cells, minlength=size) > 0
+
+    # Return the groups.
+    return bioden.store.GroupMatrix(rows.astype(np.intc),
+        np.array(group_surfaces), sums.reshape(len(rows), n_groups),
+        present.reshape(len(rows), n_groups))
+
+def group_ecotope(task):
+    """Return the raw and the normalized sample groups of an ecotope.
+
+    This function is run by worker processes. Argument `task` is a tuple
+    ``(records, targets)``, where `records` are passed to
+    :func:`group_records` for each target sample surface in list `targets`.
+    Returns a tuple ``(groups, normalized_groups)`` of lists with the
+    groups for each target.
+    """
+    records, targets = task
+    groups = [group_records(records, target) for target in targets]
+    return groups, [g.normalized(target) for g, target in
+        itertools.izip(groups, targets)]
 
 class DataProcessor(threading.Thread):
     def __init__(self):
@@ -41,20 +210,35 @@ class DataProcessor(threading.Thread):
         self._reader = None
         self._output_folder = None
         self._property = None
+        self._selected_properties = []
         self._dbfile = None
+        self._storage = 'sqlite'
+        self._float32 = False
+        self.store = None
+        self._engine = 'store'
+        self._diversity_index = 'richness'
+        self._replicates = 0
+        self._seed = 0
+        self.diversity_distributions = {}
+        self.results = None
         self._do_round = None
-        self._target_sample_surface = 0.2
+        self._target_sample_surfaces = [0.2]
         self._output_format = 'csv'
+        self._output_layout = 'wide'
         self._pdialog = None
         self.pdialog_handler = bioden.std.ProgressDialogHandler()
-        self._representative_groups = {}
+        self._representative_groups = [{}]
         self._properties = {
             'density': 'sum_of_density',
             'biomass': 'sum_of_biomass'
         }
         self.ecotopes = []
         self.taxa = []
+        self.ecotope_sizes = {}
         self.csv_dialect = csv.excel
+        self._processes = 1
+        self._ingest_key = None
+        self._processed = False
 
         # Set the path to the database file.
         self.set_directives()
@@ -69,7 +253,7 @@ class DataProcessor(threading.Thread):
 
     def set_input_file(self, filename, type):
         """Set the input file and type."""
-        supported_types = ('csv','xls')
+        supported_types = ('csv','xls','xlsx')
         if type not in supported_types:
             raise ValueError("Unknown file type '%s'." % type)
         self._input_file = (filename, type)
@@ -82,11 +266,20 @@ class DataProcessor(threading.Thread):
     def create_reader(self):
         """Set a file reader from the input file and type."""
         if self._input_file[1] == "csv":
-            reader = csv.DictReader(open(self._input_file[0]), dialect=self.csv_dialect,
-                fieldnames=None)
+            reader = csv.reader(open(self._input_file[0], 'rb'),
+                dialect=self.csv_dialect)
             self.set_reader(reader)
         elif self._input_file[1] == "xls":
-            book = xlrd.open_workbook(self._input_file[0])
+            # Only load the sheets that are actually used, and map the file
+            # into memory instead of reading it into a string.
+            book = xlrd.open_workbook(self._input_file[0], on_demand=True,
+                use_mmap=True)
+            self.set_reader(book)
+        elif self._input_file[1] == "xlsx":
+            # Read-only mode streams the rows from the file, so memory use
+            # doesn't depend on the size of the workbook.
+            book = openpyxl.load_workbook(self._input_file[0], read_only=True,
+                data_only=True)
             self.set_reader(book)
 
     def set_directives(self):
@@ -100,16 +293,86 @@ class DataProcessor(threading.Thread):
         # Set the path to the database file.
         self._dbfile = os.path.join(data_path, 'data.db')
 
+        # Set the folder for the cache of loaded input files.
+        self.cache = bioden.cache.Cache(os.path.join(data_path, 'cache'))
+
+    def set_cache_budget(self, budget):
+        """Set the maximum number of bytes used by the cache of loaded
+        input files. A budget of 0 disables the cache.
+        """
+        if not isinstance(budget, (int, long)) or budget < 0:
+            raise ValueError("Argument 'budget' must be an integer >= 0.")
+        self.cache.budget = budget
+
     def set_progress_dialog(self, dialog):
         self._pdialog = dialog
         self.pdialog_handler.set_progress_dialog(dialog)
 
     def set_property(self, property):
-        if property in self._properties:
-            self._property = property
+        """Set the property for the calculations. If `property` is a list
+        or tuple of properties, the data for all of them is loaded at once
+        and the results are made for each of them in a single run.
+        """
+        if isinstance(property, (list, tuple)):
+            properties = list(property)
         else:
-            raise ValueError("Property can be either 'density' or "
-                "'biomass', not '%s'." % property)
+            properties = [property]
+        for p in properties:
+            if p not in self._properties:
+                raise ValueError("Property can be either 'density' or "
+                    "'biomass', not '%s'." % p)
+        if not properties or len(set(properties)) != len(properties):
+            raise ValueError("Each property can be set only once.")
+        self._selected_properties = properties
+        self._property = properties[0]
+
+    def set_storage(self, storage, float32=False):
+        """Set the store for the working data. If `storage` is "sqlite", the
+        data is kept in a SQLite database file. If `storage` is "memory",
+        the data is kept in memory as NumPy arrays, where `float32` sets
+        whether the values are stored with single precision.
+        """
+        storages = ('sqlite', 'memory')
+        if storage not in storages:
+            raise ValueError("Possible storages are 'sqlite' and 'memory', not '%s'." % storage)
+        self._storage = storage
+        self._float32 = float32
+
+    def set_engine(self, engine):
+        """Set the engine which computes the results. If `engine` is
+        "store", the sample groups are computed per ecotope and saved to the
+        store. If `engine` is "matrix", they are computed for all ecotopes
+        at once with sparse matrices in memory. If `engine` is "stream",
+        each ecotope is grouped, exported and scored in a single pass, and
+        only its representative group is kept (see :meth:`stream`).
+        """
+        engines = ('store', 'matrix', 'stream')
+        if engine not in engines:
+            raise ValueError("Possible engines are 'store', 'matrix' and 'stream', not '%s'." % engine)
+        self._engine = engine
+
+    def set_diversity_index(self, index):
+        """Set the biodiversity index used for selecting the representative
+        sample groups. See :func:`bioden.diversity.diversity_indices` for
+        the possible values of `index`.
+        """
+        if index not in bioden.diversity.INDICES:
+            raise ValueError("Possible diversity indices are %s, not '%s'." %
+                (", ".join("'%s'" % x for x in bioden.diversity.INDICES), index))
+        self._diversity_index = index
+
+    def set_resampling(self, replicates, seed=0):
+        """Set the number of random sample orderings per ecotope for
+        selecting the representative sample groups. See
+        :meth:`resample_diversities`. The random orderings are made
+        with random seed `seed`. A number of 0 disables resampling.
+        """
+        if not isinstance(replicates, int) or replicates < 0:
+            raise ValueError("Argument 'replicates' must be an integer >= 0.")
+        if not isinstance(seed, int) or seed < 0:
+            raise ValueError("Argument 'seed' must be an integer >= 0.")
+        self._replicates = replicates
+        self._seed = seed
 
     def set_output_folder(self, output_folder):
         if not os.path.exists(output_folder):
@@ -122,9 +385,24 @@ class DataProcessor(threading.Thread):
         self._do_round = round_to
 
     def set_target_sample_surface(self, surface):
-        if not isinstance(surface, float) or surface <= 0:
-            raise ValueError("Argument 'surface' must be a float > 0.")
-        self._target_sample_surface = surface
+        """Set the target sample surface of the sample groups. If `surface`
+        is a list or tuple of surfaces, the groups are made for each of
+        them in a single run.
+        """
+        if isinstance(surface, (list, tuple)):
+            surfaces = list(surface)
+        else:
+            surfaces = [surface]
+        if not surfaces or not all(isinstance(s, float) and s > 0 for s in
+                surfaces):
+            raise ValueError("Argument 'surface' must be a float > 0 or a "
+                "list of floats > 0.")
+        # The surfaces are compared as they appear in the file names, so
+        # the files of one surface can't overwrite those of another.
+        if len(set(str(s) for s in surfaces)) != len(surfaces):
+            raise ValueError("Each target sample surface can be set only "
+                "once.")
+        self._target_sample_surfaces = surfaces
 
     def set_output_format(self, format):
         formats = ('csv', 'xls')
@@ -132,25 +410,56 @@ class DataProcessor(threading.Thread):
             raise ValueError("Possible formats are 'csv' and 'xls', not '%s'." % format)
         self._output_format = format
 
-    def run(self):
-        # Create a CSV or XSL generator.
-        if self._output_format == 'csv':
-            generator = bioden.exporter.CSVExporter(self)
-        elif self._output_format == 'xls':
-            generator = bioden.exporter.XLSExporter(self)
+    def set_output_layout(self, layout):
+        """Set the layout of the data rows in the ecotope files. If `layout`
+        is "wide", there is a row for each taxon with a column for each
+        sample or group. If `layout` is "sparse", the rows of the taxa that
+        have no values in the file are left out. If `layout` is "long",
+        there is a row ``(taxon, sample or group, value)`` for each value.
+        """
+        layouts = ('wide', 'sparse', 'long')
+        if layout not in layouts:
+            raise ValueError("Possible layouts are 'wide', 'sparse' and 'long', not '%s'." % layout)
+        self._output_layout = layout
+
+    def set_processes(self, number=None):
+        """Set the number of processes used for processing the data. If
+        `number` is None, the number of CPUs is used.
+        """
+        if number is None:
+            number = multiprocessing.cpu_count()
+        if not isinstance(number, int) or number < 1:
+            raise ValueError("Argument 'number' must be an integer >= 1.")
+        self._processes = number
 
+    def run(self):
         # Check if all required settings are set.
         self.check_settings()
 
+        # Create the store for the working data.
+        self.create_store()
+
         # Load the data.
         self.pdialog_handler.set_action("Loading data...")
         self.pdialog_handler.add_details("Loading data...")
         try:
-            # Create and set the file reader.
-            self.create_reader()
-
-            # Load the data.
-            self.load_data()
+            # Get the loaded data from the cache if this input was loaded
+            # before.
+            self._ingest_key = None
+            if not self.load_cached_data():
+                # Create and set the file reader.
+                self.create_reader()
+
+                # Load the data.
+                self.load_data()
+
+                # Save the loaded data to the cache.
+                self.cache_data()
+
+            # Get the results from the cache if this input was processed
+            # with the same settings before.
+            self._processed = self._engine == 'store' and \
+                self.load_workspace()
         except Exception as strerror:
             # Emit the signal that the process has failed.
             GObject.idle_add(bioden.std.sender.emit, 'load-data-failed', strerror)
@@ -160,44 +469,252 @@ class DataProcessor(threading.Thread):
         # is needed now by the progress dialog handler.
         self.pre_process()
 
-        # Set the number of times we will call pdialog_handler.increase().
-        steps = 7 + (len(self.ecotopes) * 4)
+        # Make and export the results for each selected property from the
+        # loaded data.
+        for i, property in enumerate(self._selected_properties):
+            if self.stopped():
+                break
+            self._property = property
+
+            # The results of the previous property are not needed anymore.
+            # Restore the results of this property from the cache if it
+            # was processed with the same settings before.
+            if i > 0 and self._engine == 'store':
+                self._processed = self.load_workspace()
+                if not self._processed:
+                    self.store.clear_groups()
+
+            self.run_property()
+
+        if not self.stopped():
+            # Emit the signal that the process was successful.
+            GObject.idle_add(bioden.std.sender.emit, 'process-finished')
+
+        # Close the store.
+        self.store.close()
+
+    def run_property(self):
+        """Make the sample groups for property `self._property` from the
+        loaded data, select the representative groups and export
+        everything.
+        """
+        if self._engine == 'stream':
+            self.stream_property()
+            return
+
+        # The results are read from the store, unless they are computed by
+        # the matrix engine.
+        self.results = self.store
+
+        # Set the number of times we will call pdialog_handler.increase()
+        # for this property.
+        n_surfaces = len(self._target_sample_surfaces)
+        steps = 3 + len(self.ecotopes) + n_surfaces * \
+            (4 + len(self.ecotopes) * 2)
+        if not self._processed and self._engine == 'store':
+            steps += len(self.ecotopes)
+        if self._replicates:
+            steps += n_surfaces
         self.pdialog_handler.set_total_steps(steps)
 
+        # The representative groups and biodiversity distributions of
+        # each target sample surface.
+        self._representative_groups = [{} for i in range(n_surfaces)]
+        self.diversity_distributions = {}
+
         if not self.stopped():
             # Process data for the property 'self._property'.
             self.pdialog_handler.increase("Making sample groups for property '%s'..." % (self._property))
-            # Here, pdialog_handler.increase will be called for each ecotope.
-            self.process()
+            # Here, pdialog_handler.increase will be called for each ecotope,
+            # unless the results were restored from the cache or are
+            # computed by the matrix engine.
+            if self._engine == 'matrix':
+                self.results = bioden.matrix.MatrixEngine(self.store,
+                    self._property, self._target_sample_surfaces)
+            elif not self._processed:
+                self.process()
 
         if not self.stopped():
-            # Export the results.
+            # Export the results. The non-grouped data is the same for
+            # all target sample surfaces.
             self.pdialog_handler.increase("Exporting non-grouped ecotope data...")
             # Here, pdialog_handler.increase will be called for each ecotope.
-            generator.export_ecotopes_raw()
+            self.create_generator().export_ecotopes_raw()
+
+        for surface_id, surface in enumerate(self._target_sample_surfaces):
+            # Create a CSV or XSL generator for this target sample surface.
+            generator = self.create_generator(surface_id)
+
+            # Mention the target sample surface in the actions if there
+            # is more than one.
+            if n_surfaces > 1:
+                label = " for target sample surface %s" % surface
+            else:
+                label = ""
+
+            if not self.stopped():
+                self.pdialog_handler.increase("Exporting raw ecotope groups%s..." % label)
+                # Here, pdialog_handler.increase will be called for each ecotope.
+                generator.export_ecotopes_grouped('raw')
+
+            if not self.stopped():
+                self.pdialog_handler.increase("Exporting normalized ecotope groups%s..." % label)
+                # Here, pdialog_handler.increase will be called for each ecotope.
+                generator.export_ecotopes_grouped('normalized')
+
+            if not self.stopped():
+                self.pdialog_handler.increase("Determining representative sample group for each ecotope%s..." % label)
+
+                # Take the biodiversity medians from random orderings of
+                # the samples if resampling is enabled.
+                medians = None
+                if self._replicates:
+                    distributions = self.resample_diversities(surface_id)
+                    self.diversity_distributions[surface_id] = distributions
+                    medians = dict((ecotope, np.median(diversities)) for
+                        ecotope, diversities in distributions.iteritems()
+                        if len(diversities))
+
+                if self._processed:
+                    self.select_representative_groups(medians=medians,
+                        surface_id=surface_id)
+                else:
+                    self.determine_representative_groups(medians,
+                        surface_id)
+
+            if not self.stopped() and self._replicates:
+                self.pdialog_handler.increase("Exporting biodiversity distributions%s..." % label)
+                generator.export_diversity_distributions()
+
+            if not self.stopped():
+                self.pdialog_handler.increase("Exporting representative sample groups%s..." % label)
+                generator.export_representatives()
 
         if not self.stopped():
-            self.pdialog_handler.increase("Exporting raw ecotope groups...")
-            # Here, pdialog_handler.increase will be called for each ecotope.
-            generator.export_ecotopes_grouped('raw')
+            # Save the results to the cache, so the next run with the same
+            # input and settings can skip the processing.
+            if not self._processed and self._engine == 'store':
+                self.save_workspace()
+
+            self.pdialog_handler.increase("")
+
+    def stream_property(self):
+        """Make, export and score the sample groups for property
+        `self._property` with the stream engine, and export the
+        representative groups.
+        """
+        self.results = bioden.stream.StreamEngine(self.store, self._property)
+
+        # Set the number of times we will call pdialog_handler.increase()
+        # for this property.
+        n_surfaces = len(self._target_sample_surfaces)
+        steps = 2 + len(self.ecotopes) + n_surfaces
+        if self._replicates:
+            steps += n_surfaces
+        self.pdialog_handler.set_total_steps(steps)
+
+        # The representative groups and biodiversity distributions of
+        # each target sample surface.
+        self._representative_groups = [{} for i in range(n_surfaces)]
+        self.diversity_distributions = {}
+        if self._replicates:
+            self.diversity_distributions = dict((surface_id, {}) for
+                surface_id in range(n_surfaces))
+
+        # Create a CSV or XSL generator for each target sample surface.
+        generators = [self.create_generator(surface_id) for surface_id in
+            range(n_surfaces)]
 
         if not self.stopped():
-            self.pdialog_handler.increase("Exporting normalized ecotope groups...")
+            self.pdialog_handler.increase("Making and exporting sample groups for property '%s'..." % (self._property))
             # Here, pdialog_handler.increase will be called for each ecotope.
-            generator.export_ecotopes_grouped('normalized')
+            self.stream(generators)
 
-        if not self.stopped():
-            self.pdialog_handler.increase("Determining representative sample group for each ecotope...")
-            self.determine_representative_groups()
+        for surface_id, surface in enumerate(self._target_sample_surfaces):
+            # Mention the target sample surface in the actions if there
+            # is more than one.
+            if n_surfaces > 1:
+                label = " for target sample surface %s" % surface
+            else:
+                label = ""
 
-        if not self.stopped():
-            self.pdialog_handler.increase("Exporting representative sample groups...")
-            generator.export_representatives()
+            if not self.stopped() and self._replicates:
+                self.pdialog_handler.increase("Exporting biodiversity distributions%s..." % label)
+                generators[surface_id].export_diversity_distributions()
 
+            if not self.stopped():
+                self.pdialog_handler.increase("Exporting representative sample groups%s..." % label)
+                generators[surface_id].export_representatives()
+
+        if not self.stopped():
             self.pdialog_handler.increase("")
 
-            # Emit the signal that the process was successful.
-            GObject.idle_add(bioden.std.sender.emit, 'process-finished')
+    def stream(self, generators):
+        """Make, export and score the sample groups of one ecotope at a
+        time, with the generators in list `generators` for the target
+        sample surfaces.
+
+        The records of each ecotope are read once for all target surfaces.
+        Its raw and normalized groups are written to the grouped and AMBI
+        files right away, and its representative group is selected from
+        the biodiversities of the raw groups. Only the representative
+        groups are kept in `self.results`, so nothing is saved to the
+        store, and the groups of a single ecotope are held in memory at
+        a time.
+        """
+        for ecotope_id, ecotope in enumerate(self.ecotopes):
+            if self.stopped():
+                break
+
+            # Update the progress dialog.
+            self.pdialog_handler.increase()
+            log = "Processing ecotope '%s'..." % ecotope
+            self.pdialog_handler.add_details(log)
+
+            # The non-grouped data is the same for all target sample
+            # surfaces.
+            generators[0].write_ecotope(generators[0].raw_task(ecotope))
+
+            records = self.store.sample_records(ecotope, self._property)
+            for surface_id, (generator, target) in enumerate(itertools.izip(
+                    generators, self._target_sample_surfaces)):
+                groups = group_records(records, target)
+                normalized_groups = groups.normalized(target)
+                generator.write_ecotope(generator.grouped_task(ecotope,
+                    'raw', groups))
+                generator.write_ecotope(generator.grouped_task(ecotope,
+                    'normalized', normalized_groups))
+
+                # Take the biodiversity median from random orderings of the
+                # samples if resampling is enabled. The replicates are
+                # the same as those of resample_diversities().
+                median = None
+                if self._replicates:
+                    diversities = bioden.diversity.resampled_diversities(
+                        (records, target, self._diversity_index, self._seed,
+                        ecotope_id, 0, self._replicates))
+                    self.diversity_distributions[surface_id][ecotope] = \
+                        diversities
+                    if len(diversities):
+                        median = np.median(diversities)
+
+                # Keep only the representative group.
+                group_id = self.representative_group(
+                    self.group_diversities(groups), median)
+                if group_id is not None:
+                    self._representative_groups[surface_id][ecotope] = \
+                        group_id
+                    self.results.insert_representative(ecotope, group_id,
+                        normalized_groups, surface_id)
+
+    def create_generator(self, surface_id=0):
+        """Return a CSV or XLS generator for the results of target sample
+        surface `surface_id`.
+        """
+        if self._output_format == 'csv':
+            return bioden.exporter.CSVExporter(self, surface_id)
+        elif self._output_format == 'xls':
+            return bioden.exporter.XLSExporter(self, surface_id)
 
     def check_settings(self):
         if not self._input_file:
@@ -211,472 +728,550 @@ class DataProcessor(threading.Thread):
 
         return True
 
-    def make_db(self):
-        """Create the database file with the necessary tables."""
-
-        # Delete the current database file.
-        if os.path.isfile(self._dbfile):
-            self.remove_db_file()
-
-        # This will automatically create a new database file.
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
-
-        cursor.execute("CREATE TABLE data ( \
-            id INTEGER PRIMARY KEY, \
-            sample_code INTEGER, \
-            compiled_ecotope VARCHAR, \
-            standardised_taxon VARCHAR, \
-            sum_of_density REAL, \
-            sum_of_biomass REAL \
-        )")
-
-        cursor.execute("CREATE TABLE samples ( \
-            sample_code INTEGER PRIMARY KEY, \
-            sample_surface REAL \
-        )")
-
-        cursor.execute("CREATE TABLE sums_of ( \
-            id INTEGER PRIMARY KEY, \
-            group_id INTEGER, \
-            compiled_ecotope VARCHAR, \
-            standardised_taxon VARCHAR, \
-            sum_of REAL, \
-            group_surface REAL \
-        )")
-
-        cursor.execute("CREATE TABLE normalized_sums_of (\
-            id INTEGER PRIMARY KEY, \
-            group_id INTEGER, \
-            compiled_ecotope VARCHAR, \
-            standardised_taxon VARCHAR, \
-            sum_of REAL, \
-            group_surface REAL \
-        )")
-
-        cursor.execute("CREATE TABLE biodiversity ( \
-            id INTEGER PRIMARY KEY, \
-            compiled_ecotope VARCHAR, \
-            group_id INTEGER, \
-            diversity INTEGER \
-        )")
+    def find_columns(self, fieldnames):
+        """Return a dictionary which maps each of the required field names
+        to the index of the matching column in the list of column names
+        `fieldnames`.
 
-        # Commit the transaction.
-        connection.commit()
-
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
-
-    def remove_db_file(self, tries=0):
-        """Remove the database file."""
-        if tries > 2:
-            raise EnvironmentError("Unable to remove the file %s. "
-                "Please make sure it's not in use by a different "
-                "process." % self._dbfile)
-        try:
-            os.remove(self._dbfile)
-        except:
-            tries += 1
-            time.sleep(2)
-            self.remove_db_file(tries)
-        return True
+        A column matches a field if the field name occurs in the lower case
+        column name. The first matching column is used. The index is None
+        for fields without a matching column.
+        """
+        fields = dict.fromkeys(FIELDS)
 
-    def pre_process(self):
-        # This will automatically create a new database file.
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
-
-        # Compile a list of all taxa.
-        cursor.execute("SELECT standardised_taxon FROM data")
-        for taxon in cursor:
-            if taxon[0] not in self.taxa:
-                self.taxa.append(taxon[0])
-
-        # Compile a list of all ecotopes.
-        cursor.execute("SELECT compiled_ecotope FROM data")
-        for ecotope in cursor:
-            # Convert ecotopes to lower case to account for upper/lowercase
-            # differences.
-            ecotope = ecotope[0].lower()
-
-            if ecotope not in self.ecotopes:
-                self.ecotopes.append(ecotope)
-
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
+        for f in fields:
+            for i, name in enumerate(fieldnames):
+                if f in name.lower():
+                    fields[f] = i
+                    break
 
-    def process(self):
-        """Calculate the sample groups with a sample surface of
-        'self._target_sample_surface' and save them to the database.
-        """
-        log = "Processing data for property '%s'..." % self._property
-        self.pdialog_handler.add_details(log)
+        # Check if the columns for the selected properties exist.
+        for property in self._selected_properties:
+            if fields[property] is None:
+                raise ValueError("The data file is missing the '%s' column." %
+                    property)
 
-        # Set the field to select from based on the property.
-        self.select_field = self._properties[self._property]
+        return fields
 
-        # This will automatically create a new database file.
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
+    def create_store(self):
+        """Create the store for the working data."""
+        if self._storage == 'sqlite':
+            self.store = bioden.store.SQLiteStore(self._dbfile)
+        elif self._storage == 'memory':
+            self.store = bioden.store.ArrayStore(self._selected_properties,
+                self._float32)
 
-        # Walk through each ecotope.
-        for ecotope in self.ecotopes:
-            # Update the progress dialog.
-            self.pdialog_handler.increase()
+    def ingest_key(self):
+        """Return the cache key for the data loaded from the input file.
 
-            # Create a log message.
-            log = "Processing ecotope '%s'..." % ecotope
-            self.pdialog_handler.add_details(log)
+        The key is made from the contents of the input file and all
+        settings that affect how it is loaded.
+        """
+        if self._ingest_key:
+            return self._ingest_key
 
-            # Get all sample codes matching the current ecotope.
-            cursor.execute("SELECT sample_code "
-                "FROM data "
-                "WHERE compiled_ecotope = ?",
-                (ecotope,))
-
-            sample_codes_for_ecotope = []
-            for sample_code in cursor:
-                sample_code = str(sample_code[0])
-                if sample_code not in sample_codes_for_ecotope:
-                    sample_codes_for_ecotope.append(sample_code)
-
-            # Group the sums into groups with a surface of
-            # 'self._target_sample_surface' or higher.
-            groups = self.make_groups(sample_codes_for_ecotope)
-
-            # Get each group from the sample, and insert the data for
-            # that group into the database.
-            for group_id, group in enumerate(groups, start=1):
-                # Unpack each raw group.
-                group_surface, group_data = group
-
-                # Unpack group data and insert it into the database.
-                for taxon, sum_of in group_data.iteritems():
-                    cursor.execute("INSERT INTO sums_of \
-                        VALUES (null,?,?,?,?,?)",
-                        (group_id, ecotope, taxon,
-                        sum_of, group_surface))
-
-            # Make normalized groups out of the raw groups.
-            # Make all group surfaces exactly 'self._target_sample_surface' and
-            # transform the corresponding sums accrodingly.
-            normalized_groups = self.normalize_groups(groups)
-
-            # Insert the normalized data into the database as well.
-            for group_id, group in enumerate(normalized_groups, start=1):
-                # Unpack each normalized group.
-                group_surface, group_data = group
-
-                # Unpack group data and insert it into the database.
-                for taxon, sum_of in group_data.iteritems():
-                    cursor.execute("INSERT INTO normalized_sums_of \
-                        VALUES (null,?,?,?,?,?)",
-                        (group_id, ecotope, taxon,
-                        sum_of, group_surface))
+        filename, type = self._input_file
+        if type == 'csv':
+            dialect = (self.csv_dialect.delimiter, self.csv_dialect.quotechar)
+        else:
+            dialect = None
+        self._ingest_key = bioden.cache.make_key('ingest', bioden.__version__,
+            bioden.store.STORE_FORMAT, bioden.cache.file_digest(filename),
+            type, dialect, FIELDS, tuple(self._selected_properties),
+            self._storage, self._float32)
+        return self._ingest_key
+
+    def workspace_key(self):
+        """Return the cache key for the processing results.
+
+        The key is made from the ingest key, the current property and all
+        settings that affect the results. Export settings don't affect the
+        key. The results are cached without the data, which is cached
+        under the ingest key.
+        """
+        return bioden.cache.make_key('workspace', self.ingest_key(),
+            self._property, tuple(self._target_sample_surfaces),
+            self._diversity_index)
+
+    def load_workspace(self):
+        """Restore the processing results from the cache into the store,
+        which must hold the loaded data. Return True if the results were
+        found in the cache, False otherwise.
+
+        The cache is optional, so if the results can't be restored, the
+        error is logged, the store is left without results and False is
+        returned.
+        """
+        if self.cache.budget <= 0:
+            return False
 
-        # Commit the transaction.
-        connection.commit()
-
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
-
-    def make_groups(self, sample_codes):
-        """Return sample groups with a sample surface of
-        `self._target_sample_surface` or higher for the list of sample codes
-        `sample_codes`.
-        """
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
-        cursor2 = connection.cursor()
-
-        # Select sample codes+surfaces for the sample codes in the list
-        # 'sample_codes'.
-        sample_codes = ",".join(sample_codes)
-        cursor.execute("SELECT sample_code, sample_surface "
-            "FROM samples "
-            "WHERE sample_code "
-            "IN (%s)" % sample_codes)
-
-        # This list will contain the dictionaries with sums per taxon
-        # for the supplied sample codes.
-        groups = []
-
-        # The surface of the current group.
-        group_surface = 0.0
-
-        # This dictionary contains the sum per taxon for the
-        # current group.
-        group_data = {}
-
-        for sample_code,sample_surface in cursor:
-            # A group surface is the sum of all sample surfaces that
-            # makes up the group. So each time we process a new sample,
-            # add that sample's surface to the group surface.
-            group_surface += sample_surface
-
-            # Get all taxon data for the current sample.
-            cursor2.execute("SELECT standardised_taxon, %s "
-                "FROM data "
-                "WHERE sample_code = ?" % (self.select_field),
-                (sample_code,))
-
-            # Calculate the sums of all taxa we encounter.
-            for taxon,sum_of in cursor2:
-                if taxon in group_data:
-                    group_data[taxon] += sum_of
-                else:
-                    group_data[taxon] = sum_of
+        try:
+            path = self.cache.get(self.workspace_key())
+            if not path:
+                return False
+
+            self.store.restore_groups(path)
+        except Exception as e:
+            self.pdialog_handler.add_details("Could not read the cached "
+                "results: %s" % e)
+            self.store.clear_groups()
+            return False
+
+        self.pdialog_handler.add_details("Using cached results for %s" %
+            self._input_file[0])
+        return True
 
-            # Check if we reached the current group's maximum surface.
-            if group_surface >= self._target_sample_surface:
-                # When this group reached a group_surface of
-                # 'self._target_sample_surface' or higher, add it to the
-                # 'groups' list. Note that this means that if we don't reach
-                # 'self._target_sample_surface', the group won't be processed.
-                groups.append( [group_surface,group_data] )
+    def save_workspace(self):
+        """Save the processing results to the cache, without the data.
+        The cache is optional, so if the results can't be saved, the error
+        is logged and the run goes on.
+        """
+        if self.cache.budget <= 0:
+            return
+        try:
+            self.cache.put(self.workspace_key(), self.store.save_groups)
+        except Exception as e:
+            self.pdialog_handler.add_details("Could not save the results to "
+                "the cache: %s" % e)
 
-                # Reset the current group so we can start a new group.
-                group_data = {}
-                group_surface = 0.0
+    def load_cached_data(self):
+        """Restore the loaded data from the cache. Return True if the input
+        file was found in the cache, False otherwise.
 
-        # Close connection with the local database.
-        cursor.close()
-        cursor2.close()
-        connection.close()
+        The cache is optional, so if the data can't be restored, the error
+        is logged and False is returned.
+        """
+        if self.cache.budget <= 0:
+            return False
 
-        # Return the groups.
-        return groups
+        try:
+            path = self.cache.get(self.ingest_key())
+            if not path:
+                return False
+
+            self.store.restore(path)
+        except Exception as e:
+            self.pdialog_handler.add_details("Could not read the cached "
+                "data: %s" % e)
+            return False
+
+        self.pdialog_handler.add_details("Using cached data for %s" %
+            self._input_file[0])
+        return True
 
-    def normalize_groups(self, groups):
-        """Return a normalized version of sample groups `groups`. It
-        converts the sums of the groups to a sample surface of exactly
-        `self._target_sample_surface`.
+    def cache_data(self):
+        """Save the loaded data to the cache. The cache is optional, so if
+        the data can't be saved, the error is logged and the run goes on.
+        """
+        if self.cache.budget <= 0:
+            return
+        try:
+            self.cache.put(self.ingest_key(), self.store.save,
+                self.store.saved_size())
+        except Exception as e:
+            self.pdialog_handler.add_details("Could not save the data to the "
+                "cache: %s" % e)
+
+    def insert_records(self, records):
+        """Create a new store and insert the records from iterable
+        `records` into it.
+
+        Each record is a tuple ``(sample_code, compiled_ecotope,
+        standardised_taxon, density, biomass, sample_surface)``.
         """
-        for i, group in enumerate(groups):
-            # Unpack current group.
-            group_surface, group_data = group
+        self.store.load(records)
 
-            # Skip the calculations for this group if the surface
-            # is already equal to 'self._target_sample_surface'.
-            if group_surface == self._target_sample_surface:
-                continue
+    def pre_process(self):
+        """Get the lists of all taxa and all ecotopes, and the size of each
+        ecotope.
+
+        The taxa and ecotopes are discovered while loading, in order of
+        first appearance. The sizes are counted in a single pass over the
+        data, and are saved to `self.ecotope_sizes` as a dictionary which
+        maps each ecotope to a tuple ``(samples, taxa, records)``.
+        """
+        self.taxa = self.store.taxa()
+        self.ecotopes = self.store.ecotopes()
+        self.ecotope_sizes = self.store.ecotope_sizes()
+
+        self.pdialog_handler.add_details("Found %d taxa in %d samples for %d "
+            "ecotopes." % (len(self.taxa),
+            sum(size[0] for size in self.ecotope_sizes.itervalues()),
+            len(self.ecotopes)))
 
-            # Calculate the factor needed to calculate the sum for a
-            # surface of 'self._target_sample_surface' for each group.
-            factor = self._target_sample_surface / group_surface
+    def process(self):
+        """Calculate the sample groups with a sample surface of each of
+        'self._target_sample_surfaces' and save them to the store.
 
-            # Unpack group data.
-            for taxon, sum_of in group_data.iteritems():
-                # Calculate the sum if the group surface would be
-                # 'self._target_sample_surface'.
-                new_sum_of = sum_of * factor
+        If more than one process is set with :meth:`set_processes`, the
+        ecotopes are processed by a pool of processes. Otherwise they are
+        processed in this thread.
+        """
+        log = "Processing data for property '%s'..." % self._property
+        self.pdialog_handler.add_details(log)
 
-                # Set the new sum_of value for this taxon in the current
-                # group.
-                groups[i][1][taxon] = new_sum_of
+        if self._processes > 1 and len(self.ecotopes) > 1:
+            self.parallel_process()
+        else:
+            # Walk through each ecotope.
+            for ecotope in self.ecotopes:
+                # Update the progress dialog.
+                self.pdialog_handler.increase()
 
-            # When done with all taxa for this group, set the value for
-            # group surface to 'self._target_sample_surface'.
-            groups[i][0] = self._target_sample_surface
+                # Create a log message.
+                log = "Processing ecotope '%s'..." % ecotope
+                self.pdialog_handler.add_details(log)
 
-        # Return the normalized groups.
-        return groups
+                # Group the sums into groups with a surface of each of
+                # 'self._target_sample_surfaces' or higher.
+                groups = self.make_groups(ecotope)
 
-    def __determine_biodiversities(self):
-        """Calculate the biodiversity for each sample group."""
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
+                # Make normalized groups out of the raw groups.
+                # Make all group surfaces exactly the target surface and
+                # transform the corresponding sums accrodingly.
+                normalized_groups = self.normalize_groups(groups)
 
-        for ecotope in self.ecotopes:
-            # Get the number of groups for this ecotope.
-            cursor.execute("SELECT group_id \
-                FROM sums_of \
-                WHERE compiled_ecotope = ?",
-                (ecotope,)
-                )
-            groups = []
-            for id in cursor:
-                if id[0] not in groups:
-                    groups.append(id[0])
-
-            for group_id in groups:
-                # We define the biodiversity for each group by looking
-                # up the number of taxa registered by that group ID and
-                # ecotope.
-                # Note: We exclude the taxa which have a 'sum of' of 0.
-                cursor.execute("SELECT COUNT(standardised_taxon) \
-                    FROM sums_of \
-                    WHERE compiled_ecotope = ? \
-                    AND group_id = ? \
-                    AND sum_of > 0",
-                    (ecotope, group_id)
-                    )
-                diversity = cursor.fetchone()[0]
-
-                cursor.execute("INSERT INTO biodiversity \
-                    VALUES (null,?,?,?)",
-                    (ecotope, group_id, diversity)
-                    )
+                # Save the raw and the normalized groups.
+                self.insert_groups(ecotope, groups, normalized_groups)
 
         # Commit the transaction.
-        connection.commit()
+        self.store.commit()
 
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
+    def parallel_process(self):
+        """Calculate the sample groups of the ecotopes with a pool of
+        processes and save them to the store.
 
-    def determine_representative_groups(self):
-        """Determine which sample group is the most representative
-        for each ecotope by finding which ecotope group's biodiversity
-        is closest to the biodiversity median of the ecotope.
+        The records of each ecotope are read from the store in this thread
+        and are grouped by a worker process. The largest ecotopes are
+        started first, so that a large ecotope doesn't hold back the run.
+        The groups are saved in the same order as by :meth:`process`.
         """
+        # The ecotopes to start, largest last so they can be popped first.
+        tasks = sorted(self.ecotopes,
+            key=lambda ecotope: self.ecotope_sizes[ecotope][2])
 
-        # Determine the biodiversities.
-        self.__determine_biodiversities()
+        # The workers report finished ecotopes through this queue.
+        finished = Queue.Queue()
 
-        # Connect to the database.
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
+        pool = multiprocessing.Pool(self._processes)
+        try:
+            running = {}
+            results = {}
+            saved = 0
+            while saved < len(self.ecotopes) and not self.stopped():
+                # Keep a limited number of ecotopes running, so the
+                # records of all ecotopes aren't held in memory at once.
+                while tasks and len(running) < 2 * self._processes:
+                    ecotope = tasks.pop()
+                    records = self.store.sample_records(ecotope,
+                        self._property)
+                    running[ecotope] = pool.apply_async(group_ecotope,
+                        ((records, self._target_sample_surfaces),),
+                        callback=lambda groups, ecotope=ecotope:
+                            finished.put(ecotope))
+
+                # Wait for an ecotope to finish. A failed ecotope doesn't
+                # call the callback, so its error is raised here.
+                try:
+                    ecotope = finished.get(timeout=0.1)
+                except Queue.Empty:
+                    for result in running.itervalues():
+                        if result.ready():
+                            result.get()
+                    continue
+                results[ecotope] = running.pop(ecotope).get()
+
+                # Update the progress dialog.
+                self.pdialog_handler.increase()
+                log = "Processed ecotope '%s'..." % ecotope
+                self.pdialog_handler.add_details(log)
+
+                # Save the groups in the order of the ecotopes.
+                while saved < len(self.ecotopes) and \
+                        self.ecotopes[saved] in results:
+                    ecotope = self.ecotopes[saved]
+                    groups, normalized_groups = results.pop(ecotope)
+                    self.insert_groups(ecotope, groups, normalized_groups)
+                    saved += 1
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def insert_groups(self, ecotope, groups, normalized_groups):
+        """Save the lists of raw and normalized sample groups `groups` and
+        `normalized_groups` of ecotope `ecotope` to the store, one for
+        each target sample surface.
+        """
+        for surface_id, (raw, normalized) in enumerate(itertools.izip(groups,
+                normalized_groups)):
+            self.store.insert_groups('raw', ecotope, raw, surface_id)
+            self.store.insert_groups('normalized', ecotope, normalized,
+                surface_id)
+
+    def make_groups(self, ecotope):
+        """Return a list with the sample groups with a sample surface of
+        each of `self._target_sample_surfaces` or higher for the samples of
+        ecotope `ecotope`.
+
+        The records of the ecotope are read once for all target surfaces.
+        The samples are added to the groups in order of sample code. The
+        groups are returned as :class:`bioden.store.GroupMatrix` objects.
+        """
+        # Get all records for the samples in one go, ordered by sample code.
+        records = self.store.sample_records(ecotope, self._property)
+        return [group_records(records, target) for target in
+            self._target_sample_surfaces]
 
-        # A dictionary containing the median of the biodiversities for
-        # each ecotope.
-        medians = {}
+    def normalize_groups(self, groups):
+        """Return a normalized version of the list of sample groups
+        `groups`. It converts the sums of the groups to a sample surface of
+        exactly the matching target sample surface.
+        """
+        return [g.normalized(target) for g, target in
+            itertools.izip(groups, self._target_sample_surfaces)]
+
+    def __determine_biodiversities(self, surface_id=0):
+        """Calculate the biodiversity for each sample group of target
+        sample surface `surface_id` and save it to the store. Return a
+        dictionary which maps each ecotope to the list of ``(diversity,
+        group_id)`` tuples for its groups.
+
+        All indices are calculated in a single pass over the sums of the
+        raw groups. The index set with :meth:`set_diversity_index` is used
+        as the biodiversity.
+        """
+        ecotope_ids, group_ids, sums = self.results.group_cells('raw',
+            surface_id)
+
+        # Number the groups in order of ecotope and group ID.
+        width = int(group_ids.max()) + 1 if len(group_ids) else 1
+        keys, groups = np.unique(ecotope_ids.astype(np.int64) * width +
+            group_ids, return_inverse=True)
+        indices = bioden.diversity.diversity_indices(groups, sums, len(keys))
+        key_ecotopes, key_groups = np.divmod(keys, width)
+        starts = np.searchsorted(key_ecotopes,
+            np.arange(len(self.ecotopes) + 1))
+
+        diversities = {}
+        for ecotope_id, ecotope in enumerate(self.ecotopes):
+            start, end = starts[ecotope_id:ecotope_id+2]
+            ecotope_groups = key_groups[start:end].tolist()
+            ecotope_diversities = \
+                indices[self._diversity_index][start:end].tolist()
+            self.results.insert_diversities(ecotope,
+                zip(ecotope_groups, ecotope_diversities), surface_id)
+            diversities[ecotope] = zip(ecotope_diversities, ecotope_groups)
 
-        for ecotope in self.ecotopes:
-            # Get the number of groups for this ecotope.
-            cursor.execute("SELECT diversity \
-                FROM biodiversity \
-                WHERE compiled_ecotope = ?",
-                (ecotope,)
-                )
+        # Commit the transaction.
+        self.results.commit()
 
-            # Get all biodiversities for this ecotope.
-            diversities = []
-            for diversity in cursor:
-                diversities.append(diversity[0])
+        return diversities
 
-            # Skip this ecotope if there were no diversities found, and thus
-            # no groups.
-            if len(diversities) == 0:
-                continue
+    def group_diversities(self, groups):
+        """Return the list of ``(diversity, group_id)`` tuples for the
+        groups with taxa of :class:`bioden.store.GroupMatrix` `groups`.
+        The index set with :meth:`set_diversity_index` is used as the
+        biodiversity.
+        """
+        group_ids, taxon_ids, sums, surfaces = groups.cells()
+        keys, inverse = np.unique(group_ids, return_inverse=True)
+        indices = bioden.diversity.diversity_indices(inverse, sums,
+            len(keys))
+        return zip(indices[self._diversity_index].tolist(), keys.tolist())
 
-            # Calculate the median.
-            medians[ecotope] = bioden.std.median(diversities)
+    def determine_representative_groups(self, medians=None, surface_id=0):
+        """Determine which sample group is the most representative
+        for each ecotope by finding which ecotope group's biodiversity
+        is closest to the biodiversity median of the ecotope.
 
+        Arguments `medians` and `surface_id` are passed to
+        :meth:`select_representative_groups`.
+        """
+        # Determine the biodiversities, and select the representative
+        # groups from them.
+        self.select_representative_groups(
+            self.__determine_biodiversities(surface_id), medians, surface_id)
+
+    def select_representative_groups(self, diversities=None, medians=None,
+            surface_id=0):
+        """Select the sample group with the biodiversity closest to the
+        biodiversity median of the ecotope as the most representative group
+        for each ecotope.
+
+        Argument `diversities` is a dictionary which maps each ecotope to
+        the list of ``(diversity, group_id)`` tuples for its groups. If it
+        is None, the biodiversities are read from the store. Argument
+        `medians` is a dictionary which maps ecotopes to the median to use
+        instead of the median of the biodiversities of its groups. The
+        groups of target sample surface `surface_id` are used.
+        """
         for ecotope in self.ecotopes:
-            cursor.execute("SELECT diversity, group_id \
-                FROM biodiversity \
-                WHERE compiled_ecotope = ?",
-                (ecotope,)
-                )
-
-            # Calculate the differences between the diversity median for
-            # this ecotope and all diversities from this ecotope. Save
-            # the group_id for the group with the smalles difference.
-            smallest_difference = None
-            for diversity, group_id in cursor:
-                difference = abs(medians[ecotope] - diversity)
-
-                if smallest_difference == None:
-                    smallest_difference = difference
-                    self._representative_groups[ecotope] = group_id
-                elif difference < smallest_difference:
-                    smallest_difference = difference
-                    self._representative_groups[ecotope] = group_id
-
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
+            # Get all biodiversities for this ecotope.
+            if diversities is None:
+                ecotope_diversities = self.results.diversities(ecotope,
+                    surface_id)
+            else:
+                ecotope_diversities = diversities.get(ecotope, [])
+
+            # An ecotope without biodiversities has no groups, and thus no
+            # representative group.
+            group_id = self.representative_group(ecotope_diversities,
+                medians.get(ecotope) if medians else None)
+            if group_id is not None:
+                self._representative_groups[surface_id][ecotope] = group_id
+
+    def representative_group(self, diversities, median=None):
+        """Return the ID of the group with the biodiversity closest to
+        `median` from the list of ``(diversity, group_id)`` tuples
+        `diversities`, or None if the list is empty. If `median` is None,
+        the median of the biodiversities is used.
+        """
+        if len(diversities) == 0:
+            return None
+
+        # Calculate the median.
+        values = np.array([diversity for diversity, group_id in
+            diversities], dtype=float)
+        if median is None:
+            median = bioden.std.median(values.tolist())
+
+        # Return the group_id for the group with the smallest difference
+        # between its diversity and the median. The first group wins a tie.
+        i = np.argmin(np.abs(median - values))
+        return diversities[i][1]
+
+    def resample_diversities(self, surface_id=0):
+        """Return a dictionary which maps each ecotope to an array with
+        the biodiversities of the sample groups made from random orderings
+        of its samples, for target sample surface `surface_id`.
+
+        The samples of each ecotope are grouped in the number of random
+        orders set with :meth:`set_resampling`, so the representative
+        group doesn't depend on the order of the sample codes. The
+        replicates are divided over a pool of processes if more than one
+        process is set with :meth:`set_processes`.
+        """
+        log = "Grouping the samples of each ecotope in %d random orders..." % \
+            self._replicates
+        self.pdialog_handler.add_details(log)
+
+        # Divide the replicates of each ecotope over the processes.
+        step = -(-self._replicates // self._processes)
+        tasks = []
+        for ecotope_id, ecotope in enumerate(self.ecotopes):
+            records = self.store.sample_records(ecotope, self._property)
+            for first in range(0, self._replicates, step):
+                tasks.append( (ecotope, (records,
+                    self._target_sample_surfaces[surface_id],
+                    self._diversity_index,
+                    self._seed, ecotope_id, first,
+                    min(step, self._replicates - first))) )
+
+        if self._processes > 1:
+            pool = multiprocessing.Pool(self._processes)
+            try:
+                results = pool.map(bioden.diversity.resampled_diversities,
+                    [task for ecotope, task in tasks])
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [bioden.diversity.resampled_diversities(task)
+                for ecotope, task in tasks]
+
+        # Join the replicates of each ecotope, in order of replicate.
+        distributions = dict((ecotope, []) for ecotope in self.ecotopes)
+        for (ecotope, task), diversities in itertools.izip(tasks, results):
+            distributions[ecotope].append(diversities)
+        return dict((ecotope, np.concatenate(arrays) if arrays else
+            np.zeros(0)) for ecotope, arrays in distributions.iteritems())
 
 class CSVProcessor(DataProcessor):
     """Process CSV data."""
 
     def set_reader(self, reader):
         """Set the CSV reader."""
-        if isinstance(reader, csv.DictReader):
+        if isinstance(reader, CSV_READER_TYPE):
             self._reader = reader
         else:
-            raise TypeError("Argument 'reader' must be an instance of 'csv.DictReader'.")
+            raise TypeError("Argument 'reader' must be a 'csv.reader' object.")
 
     def load_data(self):
         """Extract the required columns from the CSV data and insert
         these into the database.
-        """
-        # Create a new database file.
-        self.make_db()
-
-        # The required field names.
-        fields = {'sample code': None, 'compiled ecotope': None,
-            'standardised taxon': None, 'density': None, 'biomass': None,
-            'sample surface': None}
-
-        # Update the values in the 'fields' dictionary to the index number
-        # for the corresponding field in the CSV file.
-        fieldnames = self._reader.fieldnames
-        for f in fields:
-            for name in fieldnames:
-                if f in name.lower():
-                    fields[f] = name
-                    break
 
-        # Connect with the database.
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
+        If more than one process is set with :meth:`set_processes` and the
+        input file is large enough, the file is parsed by a pool of
+        processes. Otherwise it is parsed in this thread.
+        """
+        filename = self._input_file[0]
+        if self._processes > 1 and \
+                os.path.getsize(filename) >= PARALLEL_MIN_FILE_SIZE:
+            self.insert_records(self.parallel_records(filename))
+            return
 
-        # List of sample codes. Used to check which sample codes have
-        # already been inserted into the database.
-        sample_codes = []
+        # The first row contains the field names. Resolve these to column
+        # indexes once, so the rows don't need to be decoded to
+        # dictionaries.
+        fields = self.find_columns(next(self._reader))
 
         # Insert CSV data into database.
-        for row in self._reader:
-            sample_code = int(row[fields['sample code']])
-
-            # Insert the data into the 'data' table.
-            if self._property == 'density':
-                if not fields['density']:
-                    raise ValueError("The data file is missing the 'density' column.")
-
-                cursor.execute("INSERT INTO data VALUES (null,?,?,?,?,null)",
-                    (sample_code,
-                    row[fields['compiled ecotope']].lower(), # Save ecotopes in lower case.
-                    row[fields['standardised taxon']],
-                    bioden.std.to_float(row[fields['density']])
-                    ))
-            elif self._property == 'biomass':
-                if not fields['biomass']:
-                    raise ValueError("The data file is missing the 'biomass' column.")
-
-                cursor.execute("INSERT INTO data VALUES (null,?,?,?,null,?)",
-                    (sample_code,
-                    row[fields['compiled ecotope']].lower(), # Save ecotopes in lower case.
-                    row[fields['standardised taxon']],
-                    bioden.std.to_float(row[fields['biomass']])
-                    ))
-
-            # Check is the current sample code is in the list of sample
-            # codes.
-            if sample_code not in sample_codes:
-                # If not, add it to the list of sample codes, and
-                # insert the sample code + surface into the 'samples'
-                # table.
-                sample_codes.append(sample_code)
-
-                # Sample codes and sample surfaces are saved in a
-                # separate table because each sample code is linked
-                # to a single sample surface.
-                cursor.execute("INSERT INTO samples VALUES (?,?)",
-                    ( sample_code, bioden.std.to_float(row[fields['sample surface']]) )
-                    )
+        self.insert_records(csv_records(self._reader, fields,
+            self._selected_properties))
 
-        # Commit the transaction.
-        connection.commit()
+    def parallel_records(self, filename):
+        """Return an iterator which generates the records from CSV file
+        `filename`, which is parsed in chunks by a pool of processes.
 
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
+        The records are generated in the same order as they appear in the
+        file. A limited number of chunks is parsed ahead of the records
+        being inserted, so the parsed chunks don't pile up in memory when
+        the store is slower than the workers.
+        """
+        delimiter = self.csv_dialect.delimiter
+        quotechar = self.csv_dialect.quotechar
+
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # The first record contains the field names.
+                header_end = find_record_end(data, 0, 0, quotechar)
+                header = next(csv.reader(data[:header_end].splitlines(True),
+                    dialect=csv.excel, delimiter=delimiter,
+                    quotechar=quotechar))
+                fields = self.find_columns(header)
+
+                # Split the remaining data on record boundaries.
+                tasks = []
+                start = header_end
+                while start < len(data):
+                    end = find_record_end(data, start,
+                        min(start + PARALLEL_CHUNK_SIZE, len(data)), quotechar)
+                    tasks.append( (filename, start, end, delimiter, quotechar,
+                        fields, self._selected_properties) )
+                    start = end
+            finally:
+                data.close()
+
+        # The chunks are started in order, so their results can be taken
+        # from the front of the queue.
+        tasks.reverse()
+        running = collections.deque()
+
+        pool = multiprocessing.Pool(self._processes)
+        try:
+            while tasks or running:
+                while tasks and len(running) < 2 * self._processes:
+                    running.append(pool.apply_async(parse_csv_chunk,
+                        (tasks.pop(),)))
+                for record in running.popleft().get():
+                    yield record
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
 class XLSProcessor(DataProcessor):
     """Process XSL data."""
@@ -685,91 +1280,109 @@ class XLSProcessor(DataProcessor):
         """Set the XSL reader."""
         if isinstance(book, xlrd.Book):
             # By default, use the first sheet in the Excel file.
-            self._reader = self.sheet = book.sheets()[0]
+            self.book = book
+            self._reader = self.sheet = book.sheet_by_index(0)
         else:
             raise TypeError("Argument 'book' must be an instance of 'xlrd.Book'.")
 
     def load_data(self):
-        """Extract the required columns from the CSV data and insert
+        """Extract the required columns from the XLS data and insert
         these into the database.
         """
-        # Create a new database file.
-        self.make_db()
+        # The first row contains the field names.
+        fields = self.find_columns(self.sheet.row_values(0))
 
-        # The required field names.
-        fields = {'sample code': None, 'compiled ecotope': None,
-            'standardised taxon': None, 'density': None, 'biomass': None,
-            'sample surface': None}
+        # Insert XLS data into database.
+        self.insert_records(self.records(fields))
 
-        # Update the values in the 'fields' dictionary to the index number
-        # for the corresponding field in the XSL file.
-        fieldnames = self.sheet.row_values(0)
-        for f in fields:
-            for name in fieldnames:
-                if f in name.lower():
-                    fields[f] = fieldnames.index(name)
-                    break
+        # Release the memory mapped file and the loaded sheet.
+        self.book.release_resources()
 
-        # Connect with the database.
-        connection = sqlite.connect(self._dbfile)
-        cursor = connection.cursor()
+    def records(self, fields):
+        """Return an iterator which generates the records from the XLS
+        sheet, where `fields` maps the required field names to column
+        indexes.
+        """
+        # Only get the columns we need, in bulk. Skip the first row, as this
+        # row contains the field names.
+        sample_codes, ecotopes, taxa, surfaces = [
+            self.sheet.col_values(fields[f], start_rowx=1) for f in
+            ('sample code', 'compiled ecotope', 'standardised taxon',
+            'sample surface')]
+
+        # Convert the columns in one pass. The columns of the properties
+        # which aren't selected are None.
+        sample_codes = [int(x) for x in sample_codes]
+        ecotopes = [x.lower() for x in ecotopes]
+        values = {}
+        for property in ('density', 'biomass'):
+            if property in self._selected_properties:
+                values[property] = [bioden.std.to_float(x) for x in
+                    self.sheet.col_values(fields[property], start_rowx=1)]
+            else:
+                values[property] = itertools.repeat(None)
+
+        return itertools.izip(sample_codes, ecotopes, taxa,
+            values['density'], values['biomass'], surfaces)
+
+class XLSXProcessor(DataProcessor):
+    """Process XLSX data."""
 
-        # List of sample codes. Used to check which sample codes have
-        # already been inserted into the database.
-        sample_codes = []
+    def set_reader(self, book):
+        """Set the XLSX reader."""
+        if isinstance(book, openpyxl.Workbook) and book.read_only:
+            # By default, use the first sheet in the Excel file.
+            self.book = book
+            self._reader = self.sheet = book.worksheets[0]
+        else:
+            raise TypeError("Argument 'book' must be a read-only instance of "
+                "'openpyxl.Workbook'.")
 
-        # Insert CSV data into database.
-        for row_n in range(self.sheet.nrows):
-            # Skip the first row, as this row contains the field names.
-            if row_n == 0:
-                continue
+    def load_data(self):
+        """Extract the required columns from the XLSX data and insert
+        these into the database.
+        """
+        rows = self.sheet.iter_rows(values_only=True)
 
-            # Get the values for the current row.
-            row = self.sheet.row_values(row_n)
-
-            # Get the sample code from the current row.
-            sample_code = int(row[fields['sample code']])
-
-            # Insert the data into the 'data' table.
-            if self._property == 'density':
-                if not fields['density']:
-                    raise ValueError("The data file is missing the 'density' column.")
-
-                cursor.execute("INSERT INTO data VALUES (null,?,?,?,?,null)",
-                    (sample_code,
-                    row[fields['compiled ecotope']].lower(), # Save ecotopes in lower case.
-                    row[fields['standardised taxon']],
-                    bioden.std.to_float(row[fields['density']])
-                    ))
-            elif self._property == 'biomass':
-                if not fields['biomass']:
-                    raise ValueError("The data file is missing the 'biomass' column.")
-
-                cursor.execute("INSERT INTO data VALUES (null,?,?,?,null,?)",
-                    (sample_code,
-                    row[fields['compiled ecotope']].lower(), # Save ecotopes in lower case.
-                    row[fields['standardised taxon']],
-                    bioden.std.to_float(row[fields['biomass']])
-                    ))
-
-            # Check if the current sample code is in the list of sample
-            # codes.
-            if sample_code not in sample_codes:
-                # If not, add it to the list of sample codes, and
-                # insert the sample code + surface into the 'samples'
-                # table.
-                sample_codes.append(sample_code)
-
-                # Sample codes and sample surfaces are saved in a
-                # separate table because each sample code is linked
-                # to a single sample surface.
-                cursor.execute("INSERT INTO samples VALUES (?,?)",
-                    ( sample_code, bioden.std.to_float(row[fields['sample surface']]) )
-                    )
+        # The first row contains the field names. Empty cells are None.
+        fields = self.find_columns([name or '' for name in next(rows)])
 
-        # Commit the transaction.
-        connection.commit()
+        # Insert XLSX data into database.
+        self.insert_records(self.records(rows, fields))
 
-        # Close connection with the local database.
-        cursor.close()
-        connection.close()
+        # Close the workbook file.
+        self.book.close()
+
+    def records(self, rows, fields):
+        """Return an iterator which generates the records from the XLSX
+        rows `rows`, where `fields` maps the required field names to column
+        indexes.
+        """
+        # The cells hold numbers or strings, so the rows are converted like
+        # CSV rows.
+        return csv_records(self.filled_rows(rows, fields), fields,
+            self._selected_properties)
+
+    def filled_rows(self, rows, fields):
+        """Return an iterator which generates the XLSX rows `rows` that
+        have a sample code, where `fields` maps the required field names
+        to column indexes.
+
+        Empty rows are skipped, as these are often found at the end of a
+        sheet. An empty cell for a selected property raises a ValueError,
+        because it would otherwise be taken for a missing taxon.
+        """
+        sample_code = fields['sample code']
+        properties = [(property, fields[property]) for property in
+            self._selected_properties]
+
+        # The first row contains the field names.
+        for row_number, row in enumerate(rows, 2):
+            if row[sample_code] is None:
+                continue
+            for property, column in properties:
+                if row[column] is None:
+                    raise ValueError("Cell %s%d of the data file is empty. "
+                        "The '%s' column must have a value in each row." %
+                        (get_column_letter(column + 1), row_number, property))
+            yield row
@@ -26,7 +26,7 @@ from gi.repository import GObject
 def to_float(x):
     """Return the float from a number which uses a comma as the decimal
     separator."""
-    if isinstance(x, str):
+    if isinstance(x, basestring):
         x = float(x.replace(',','.'))
     return x
 
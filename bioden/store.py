@@ -0,0 +1,1195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010, 2011, 2015 GiMaRIS <info@gimaris.com>
+#
+#  This file is part of BioDen - A data normalizer and transponer for
+#  files containing taxon biomass/density data for ecotopes.
+#
+#  BioDen is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  BioDen is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import itertools
+import array
+import shutil
+from sqlite3 import dbapi2 as sqlite
+
+import numpy as np
+
+import bioden.std
+
+# The number of records inserted into the store at once.
+INSERT_BATCH_SIZE = 10000
+
+# The size of the SQLite page cache in KiB.
+DB_CACHE_SIZE = 256000
+
+# The version of the layout of the stores. It is increased when the layout
+# changes, so stores saved with an older layout aren't restored.
+STORE_FORMAT = 5
+
+def add(a, b):
+    """Return the sum of `a` and `b`, where None counts as no value."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+def aggregate(records):
+    """Return the list of records `records` where the records with the same
+    sample code, ecotope and taxon are summed into a single record. The
+    records keep the order in which they first appear.
+    """
+    aggregated = []
+    index = {}
+    for record in records:
+        key = record[:3]
+        i = index.get(key)
+        if i is None:
+            index[key] = len(aggregated)
+            aggregated.append(record)
+        else:
+            # Add the density and the biomass to the earlier record.
+            first = aggregated[i]
+            aggregated[i] = first[:3] + (add(first[3], record[3]),
+                add(first[4], record[4])) + first[5:]
+    return aggregated
+
+def distinct_counts(groups, values, n):
+    """Return an array with the number of distinct values in array `values`
+    for each group ID 0 to `n`-1 in array `groups`.
+    """
+    if len(groups) == 0:
+        return np.zeros(n, dtype=np.int_)
+    order = np.lexsort((values, groups))
+    groups = groups[order]
+    values = values[order]
+    first = np.concatenate(([True], (groups[1:] != groups[:-1]) |
+        (values[1:] != values[:-1])))
+    return np.bincount(groups[first], minlength=n)
+
+def record_arrays(rows):
+    """Return the list of ``(sample_code, sample_surface, taxon_id, value)``
+    tuples `rows` as a tuple of arrays, one for each column.
+    """
+    if rows:
+        codes, surfaces, taxon_ids, values = zip(*rows)
+    else:
+        codes = surfaces = taxon_ids = values = ()
+    return (np.array(codes, dtype=np.int_), np.array(surfaces, dtype=float),
+        np.array(taxon_ids, dtype=np.intc), np.array(values, dtype=float))
+
+def selected_sums(groups):
+    """Return an iterator which generates a tuple ``(taxon_id, ecotope,
+    sum)`` for each taxon in the list of ``(ecotope, taxon_ids, sums)``
+    tuples `groups`, ordered by taxon ID. The taxa of a group are given
+    by arrays `taxon_ids` and `sums`. Taxa with the same ID stay in the
+    order of the groups.
+    """
+    if not groups:
+        return iter([])
+    names, taxon_ids, sums = zip(*groups)
+    ecotopes = np.repeat(np.arange(len(names)), [len(x) for x in taxon_ids])
+    taxon_ids = np.concatenate(taxon_ids)
+    order = np.argsort(taxon_ids, kind='mergesort')
+    return itertools.izip(taxon_ids[order].tolist(),
+        [names[i] for i in ecotopes[order].tolist()],
+        np.concatenate(sums)[order].tolist())
+
+class GroupMatrix(object):
+    """The sample groups of an ecotope as a taxon by group matrix.
+
+    Array `taxon_ids` holds the sorted IDs of the taxa for the rows and
+    array `surfaces` holds the surfaces of the groups for the columns. The
+    column index of a group is its group ID minus 1. Array `sums` holds
+    the sum of each taxon in each group, and boolean array `present` tells
+    which taxa occur in which groups.
+    """
+
+    def __init__(self, taxon_ids, surfaces, sums, present):
+        self.taxon_ids = taxon_ids
+        self.surfaces = surfaces
+        self.sums = sums
+        self.present = present
+
+    @classmethod
+    def from_cells(cls, group_ids, taxon_ids, sums, surfaces):
+        """Return a group matrix for the cells returned by :meth:`cells`."""
+        n_groups = int(group_ids.max()) if len(group_ids) else 0
+        rows, inverse = np.unique(taxon_ids, return_inverse=True)
+        columns = group_ids - 1
+        matrix = cls(rows.astype(np.intc), np.full(n_groups, np.nan),
+            np.zeros((len(rows), n_groups)),
+            np.zeros((len(rows), n_groups), dtype=bool))
+        matrix.surfaces[columns] = surfaces
+        matrix.sums[inverse, columns] = sums
+        matrix.present[inverse, columns] = True
+        return matrix
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def normalized(self, surface):
+        """Return a copy of the groups where the sums are converted to a
+        group surface of exactly `surface`.
+        """
+        # The factor for a group which already has the surface is exactly
+        # 1, so its sums stay the same.
+        factors = surface / self.surfaces
+        return GroupMatrix(self.taxon_ids, np.full(len(self), surface),
+            self.sums * factors, self.present)
+
+    def cells(self):
+        """Return the cells for the taxa that occur in the groups as a
+        tuple of arrays ``(group_ids, taxon_ids, sums, surfaces)``, ordered
+        by group ID and taxon ID.
+        """
+        columns, rows = np.nonzero(self.present.T)
+        return (columns + 1, self.taxon_ids[rows], self.sums[rows, columns],
+            self.surfaces[columns])
+
+    def group_surfaces(self):
+        """Return the list of ``(group_id, group_surface)`` tuples for the
+        groups with taxa, ordered by group ID.
+        """
+        columns = np.flatnonzero(self.present.any(axis=0))
+        return zip((columns + 1).tolist(), self.surfaces[columns].tolist())
+
+    def taxon_sums(self):
+        """Return an iterator which generates a tuple ``(taxon_id,
+        group_id, sum)`` for each taxon in each group, ordered by taxon ID.
+        """
+        rows, columns = np.nonzero(self.present)
+        return itertools.izip(self.taxon_ids[rows].tolist(),
+            (columns + 1).tolist(), self.sums[rows, columns].tolist())
+
+class Store(object):
+    """Super class for the stores which hold the working data.
+
+    The records are loaded into the store with :meth:`load`. The data
+    processor saves the sample groups and the biodiversities to the store,
+    and the generators of :mod:`bioden.exporter` read everything back
+    from it.
+
+    Taxon and ecotope names are interned while loading. Each name gets an
+    integer ID in order of first appearance, which the store uses instead
+    of the name internally.
+    """
+
+    def load(self, records):
+        """Create a new store and insert the records from iterable `records`
+        into it.
+
+        Each record is a tuple ``(sample_code, compiled_ecotope,
+        standardised_taxon, density, biomass, sample_surface)``. The records
+        are inserted in batches of :data:`INSERT_BATCH_SIZE` records.
+        Records for the same ecotope, sample and taxon are summed, so the
+        store holds a single record for each of them.
+        """
+        self.create()
+
+        # Set of sample codes. Used to check which sample codes have
+        # already been inserted.
+        sample_codes = set()
+
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, INSERT_BATCH_SIZE))
+            if not batch:
+                break
+
+            # Each sample code is linked to a single sample surface, so
+            # samples are saved separately.
+            samples = []
+            for record in batch:
+                if record[0] not in sample_codes:
+                    sample_codes.add(record[0])
+                    samples.append( (record[0], bioden.std.to_float(record[5])) )
+
+            self.insert(aggregate(batch), samples)
+
+        self.commit()
+        self.optimize()
+
+    def reset_names(self):
+        """Forget all interned taxon and ecotope names."""
+        self._taxa = []
+        self._taxon_ids = {}
+        self._ecotopes = []
+        self._ecotope_ids = {}
+
+    def _intern(self, name, names, ids):
+        """Return the ID for `name`. New names are appended to list `names`
+        and added to dictionary `ids`.
+        """
+        id = ids.get(name)
+        if id is None:
+            id = ids[name] = len(names)
+            names.append(name)
+        return id
+
+    def taxa(self):
+        """Return a list of all taxa."""
+        return list(self._taxa)
+
+    def ecotopes(self):
+        """Return a list of all ecotopes."""
+        return list(self._ecotopes)
+
+class SQLiteStore(Store):
+    """Keep the working data in the SQLite database file `dbfile`.
+
+    Taxa and ecotopes are saved in lookup tables, and all other tables
+    refer to them by ID. The indexes cover the columns of the queries
+    made by the data processor and the generators.
+    """
+
+    def __init__(self, dbfile):
+        self._dbfile = dbfile
+        self.connection = None
+        self._properties = {
+            'density': 'sum_of_density',
+            'biomass': 'sum_of_biomass'
+        }
+        self._tables = {
+            'raw': 'sums_of',
+            'normalized': 'normalized_sums_of'
+        }
+        self.reset_names()
+
+    def connect(self):
+        """Return the connection with the database file. The connection is
+        created if it doesn't exist yet.
+        """
+        if not self.connection:
+            self.connection = sqlite.connect(self._dbfile)
+
+            # The database is recreated on every run, so there is no need to
+            # protect it against crashes. This makes writes a lot faster.
+            self.connection.execute("PRAGMA journal_mode = OFF")
+            self.connection.execute("PRAGMA synchronous = OFF")
+            self.connection.execute("PRAGMA cache_size = -%d" % DB_CACHE_SIZE)
+        return self.connection
+
+    def close(self):
+        """Close the connection with the database file."""
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def commit(self):
+        """Commit the current transaction."""
+        self.connect().commit()
+
+    def clear_groups(self):
+        """Delete all sample groups and biodiversities, but keep the
+        data.
+        """
+        cursor = self.connect().cursor()
+        for table in self._tables.values():
+            cursor.execute("DELETE FROM %s" % table)
+        cursor.execute("DELETE FROM biodiversity")
+        self.commit()
+        cursor.close()
+
+    def create(self):
+        """Create the database file with the necessary tables."""
+        self.close()
+        self.reset_names()
+
+        # Delete the current database file.
+        if os.path.isfile(self._dbfile):
+            self.remove_db_file()
+
+        # This will automatically create a new database file.
+        cursor = self.connect().cursor()
+
+        cursor.execute("CREATE TABLE taxa ( \
+            taxon_id INTEGER PRIMARY KEY, \
+            standardised_taxon VARCHAR \
+        )")
+
+        cursor.execute("CREATE TABLE ecotopes ( \
+            ecotope_id INTEGER PRIMARY KEY, \
+            compiled_ecotope VARCHAR \
+        )")
+
+        cursor.execute("CREATE TABLE data ( \
+            id INTEGER PRIMARY KEY, \
+            sample_code INTEGER, \
+            ecotope_id INTEGER, \
+            taxon_id INTEGER, \
+            sum_of_density REAL, \
+            sum_of_biomass REAL \
+        )")
+
+        cursor.execute("CREATE TABLE samples ( \
+            sample_code INTEGER PRIMARY KEY, \
+            sample_surface REAL \
+        )")
+
+        cursor.execute("CREATE TABLE sums_of ( \
+            id INTEGER PRIMARY KEY, \
+            surface_id INTEGER, \
+            group_id INTEGER, \
+            ecotope_id INTEGER, \
+            taxon_id INTEGER, \
+            sum_of REAL, \
+            group_surface REAL \
+        )")
+
+        cursor.execute("CREATE TABLE normalized_sums_of (\
+            id INTEGER PRIMARY KEY, \
+            surface_id INTEGER, \
+            group_id INTEGER, \
+            ecotope_id INTEGER, \
+            taxon_id INTEGER, \
+            sum_of REAL, \
+            group_surface REAL \
+        )")
+
+        cursor.execute("CREATE TABLE biodiversity ( \
+            id INTEGER PRIMARY KEY, \
+            surface_id INTEGER, \
+            ecotope_id INTEGER, \
+            group_id INTEGER, \
+            diversity REAL \
+        )")
+
+        # Each sample has a single record per ecotope and taxon. This index
+        # is used to add up duplicate records while loading.
+        cursor.execute("CREATE UNIQUE INDEX data_key \
+            ON data (sample_code, ecotope_id, taxon_id)")
+
+        # The groups are looked up by target surface, ecotope and group ID,
+        # and by target surface, ecotope and taxon.
+        for table in self._tables.values():
+            cursor.execute("CREATE INDEX %s_group \
+                ON %s (surface_id, ecotope_id, group_id, taxon_id, sum_of, \
+                group_surface)" % (table, table))
+            cursor.execute("CREATE INDEX %s_taxon \
+                ON %s (surface_id, ecotope_id, taxon_id, group_id, sum_of)" %
+                (table, table))
+
+        cursor.execute("CREATE INDEX biodiversity_ecotope \
+            ON biodiversity (surface_id, ecotope_id, group_id, diversity)")
+
+        # Commit the transaction.
+        self.commit()
+        cursor.close()
+
+    def optimize(self):
+        """Create the indexes for the data table and update the statistics
+        used by the query planner. This is called after loading, because
+        building the indexes at once is faster than updating them for each
+        insert.
+        """
+        cursor = self.connect().cursor()
+
+        # The data is looked up by sample, by ecotope, and by ecotope and
+        # taxon.
+        cursor.execute("CREATE INDEX data_ecotope \
+            ON data (ecotope_id, sample_code)")
+        cursor.execute("CREATE INDEX data_sample \
+            ON data (sample_code, taxon_id, sum_of_density, sum_of_biomass)")
+        cursor.execute("CREATE INDEX data_ecotope_taxon \
+            ON data (ecotope_id, taxon_id, sample_code, sum_of_density, \
+            sum_of_biomass)")
+
+        cursor.execute("ANALYZE")
+        self.commit()
+        cursor.close()
+
+    def remove_db_file(self, tries=0):
+        """Remove the database file."""
+        if tries > 2:
+            raise EnvironmentError("Unable to remove the file %s. "
+                "Please make sure it's not in use by a different "
+                "process." % self._dbfile)
+        try:
+            os.remove(self._dbfile)
+        except:
+            tries += 1
+            time.sleep(2)
+            self.remove_db_file(tries)
+        return True
+
+    def saved_size(self):
+        """Return the size in bytes of the file saved by :meth:`save`."""
+        self.commit()
+        return os.path.getsize(self._dbfile)
+
+    def save(self, path):
+        """Save a copy of the database file to `path`."""
+        self.commit()
+        self.close()
+        shutil.copyfile(self._dbfile, path)
+
+    def save_groups(self, path):
+        """Save the sample groups and the biodiversities to a new database
+        file `path`, without the data.
+        """
+        self.commit()
+        connection = self.connect()
+        connection.execute("ATTACH DATABASE ? AS saved", (path,))
+        try:
+            for table in self._tables.values() + ['biodiversity']:
+                connection.execute("CREATE TABLE saved.%s AS \
+                    SELECT * FROM %s" % (table, table))
+            connection.commit()
+        finally:
+            # The database can't be detached during a transaction.
+            connection.rollback()
+            connection.execute("DETACH DATABASE saved")
+
+    def restore_groups(self, path):
+        """Replace the sample groups and the biodiversities by those in
+        file `path`, which was saved with :meth:`save_groups`. The data
+        must be the same as when they were saved.
+        """
+        self.clear_groups()
+        connection = self.connect()
+        connection.execute("ATTACH DATABASE ? AS saved", (path,))
+        try:
+            for table in self._tables.values() + ['biodiversity']:
+                connection.execute("INSERT INTO %s SELECT * FROM saved.%s" %
+                    (table, table))
+            connection.commit()
+        finally:
+            # The database can't be detached during a transaction.
+            connection.rollback()
+            connection.execute("DETACH DATABASE saved")
+
+    def restore(self, path):
+        """Replace the database file by the copy at `path`, which was saved
+        with :meth:`save`.
+        """
+        self.close()
+        if os.path.isfile(self._dbfile):
+            self.remove_db_file()
+        shutil.copyfile(path, self._dbfile)
+
+        # Load the interned names from the lookup tables.
+        self.reset_names()
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT standardised_taxon FROM taxa ORDER BY taxon_id")
+        for taxon, in cursor:
+            self._intern(taxon, self._taxa, self._taxon_ids)
+        cursor.execute("SELECT compiled_ecotope FROM ecotopes ORDER BY ecotope_id")
+        for ecotope, in cursor:
+            self._intern(ecotope, self._ecotopes, self._ecotope_ids)
+        cursor.close()
+
+    def insert(self, records, samples):
+        """Insert the list of records `records` and the list of
+        ``(sample_code, sample_surface)`` tuples `samples`.
+        """
+        cursor = self.connect().cursor()
+
+        # Intern the taxon and ecotope names, and save the new ones in the
+        # lookup tables.
+        n_taxa = len(self._taxa)
+        n_ecotopes = len(self._ecotopes)
+        rows = [(record[0],
+            self._intern(record[1], self._ecotopes, self._ecotope_ids),
+            self._intern(record[2], self._taxa, self._taxon_ids),
+            record[3], record[4]) for record in records]
+        cursor.executemany("INSERT INTO taxa VALUES (?,?)",
+            ((self._taxon_ids[taxon], taxon) for taxon in self._taxa[n_taxa:]))
+        cursor.executemany("INSERT INTO ecotopes VALUES (?,?)",
+            ((self._ecotope_ids[ecotope], ecotope)
+            for ecotope in self._ecotopes[n_ecotopes:]))
+
+        # Add the values to the records which were inserted by earlier
+        # batches, then insert the records which are new. NULL counts as
+        # no value, like in add().
+        cursor.executemany("UPDATE data \
+            SET sum_of_density = CASE \
+                WHEN ?4 IS NULL THEN sum_of_density \
+                WHEN sum_of_density IS NULL THEN ?4 \
+                ELSE sum_of_density + ?4 END, \
+            sum_of_biomass = CASE \
+                WHEN ?5 IS NULL THEN sum_of_biomass \
+                WHEN sum_of_biomass IS NULL THEN ?5 \
+                ELSE sum_of_biomass + ?5 END \
+            WHERE sample_code = ?1 \
+            AND ecotope_id = ?2 \
+            AND taxon_id = ?3", rows)
+        cursor.executemany("INSERT OR IGNORE INTO data \
+            VALUES (null,?,?,?,?,?)", rows)
+        cursor.executemany("INSERT INTO samples VALUES (?,?)", samples)
+        cursor.close()
+
+    def ecotope_sizes(self):
+        """Return a dictionary which maps each ecotope to a tuple
+        ``(samples, taxa, records)`` with the number of samples, taxa and
+        records for that ecotope.
+        """
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT ecotope_id, COUNT(DISTINCT sample_code), \
+            COUNT(DISTINCT taxon_id), COUNT(*) \
+            FROM data \
+            GROUP BY ecotope_id")
+        sizes = {}
+        for ecotope_id, samples, taxa, records in cursor:
+            sizes[self._ecotopes[ecotope_id]] = (samples, taxa, records)
+        cursor.close()
+        return sizes
+
+    def sample_codes(self, ecotope):
+        """Return the sorted list of sample codes for ecotope `ecotope`."""
+        if ecotope not in self._ecotope_ids:
+            return []
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT DISTINCT sample_code "
+            "FROM data "
+            "WHERE ecotope_id = ? "
+            "ORDER BY sample_code",
+            (self._ecotope_ids[ecotope],))
+        sample_codes = [sample_code for sample_code, in cursor]
+        cursor.close()
+        return sample_codes
+
+    def sample_records(self, ecotope, property):
+        """Return the records for property `property` of the samples in
+        ecotope `ecotope`, ordered by sample code.
+
+        The records are returned as a tuple of arrays ``(sample_codes,
+        sample_surfaces, taxon_ids, values)`` with one item per record. The
+        taxon IDs are indexes in the list returned by :meth:`taxa`.
+        """
+        if ecotope not in self._ecotope_ids:
+            return record_arrays([])
+
+        # The samples of the ecotope are selected with a subquery, so the
+        # size of the statement doesn't depend on the number of samples.
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT d.sample_code, s.sample_surface, d.taxon_id, d.%s "
+            "FROM data d "
+            "JOIN samples s ON s.sample_code = d.sample_code "
+            "WHERE d.sample_code IN "
+                "(SELECT sample_code FROM data WHERE ecotope_id = ?) "
+            "ORDER BY d.sample_code" % self._properties[property],
+            (self._ecotope_ids[ecotope],))
+        records = record_arrays(cursor.fetchall())
+        cursor.close()
+        return records
+
+    def records(self, property):
+        """Return all records for property `property` as a tuple of arrays
+        ``(sample_codes, ecotope_ids, taxon_ids, values)``.
+        """
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT sample_code, ecotope_id, taxon_id, %s \
+            FROM data" % self._properties[property])
+        rows = cursor.fetchall()
+        cursor.close()
+        if rows:
+            codes, ecotope_ids, taxon_ids, values = zip(*rows)
+        else:
+            codes = ecotope_ids = taxon_ids = values = ()
+        return (np.array(codes, dtype=np.int_),
+            np.array(ecotope_ids, dtype=np.intc),
+            np.array(taxon_ids, dtype=np.intc),
+            np.array(values, dtype=float))
+
+    def sample_surfaces(self):
+        """Return the sample codes and the sample surfaces of all samples
+        as a tuple of arrays ``(sample_codes, sample_surfaces)``.
+        """
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT sample_code, sample_surface FROM samples")
+        rows = cursor.fetchall()
+        cursor.close()
+        return (np.array([row[0] for row in rows], dtype=np.int_),
+            np.array([row[1] for row in rows], dtype=float))
+
+    def taxon_values(self, ecotope, property):
+        """Return an iterator which generates a tuple ``(taxon_id,
+        sample_code, value)`` with the value of property `property` for
+        each record of ecotope `ecotope`, ordered by taxon ID.
+
+        The records are read in a single scan of the index on ecotope and
+        taxon.
+        """
+        if ecotope not in self._ecotope_ids:
+            return
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT taxon_id, sample_code, %s \
+            FROM data \
+            WHERE ecotope_id = ? \
+            ORDER BY taxon_id, sample_code" % self._properties[property],
+            (self._ecotope_ids[ecotope],)
+            )
+        for row in cursor:
+            yield row
+        cursor.close()
+
+    def insert_groups(self, data_type, ecotope, groups, surface_id=0):
+        """Save the sample groups of ecotope `ecotope` from
+        :class:`GroupMatrix` `groups`. Set `data_type` to "raw" or
+        "normalized" for the type of the groups, and `surface_id` to the
+        index of their target sample surface.
+        """
+        ecotope_id = self._ecotope_ids[ecotope]
+        group_ids, taxon_ids, sums, surfaces = groups.cells()
+        cursor = self.connect().cursor()
+        cursor.executemany("INSERT INTO %s \
+            VALUES (null,?,?,?,?,?,?)" % self._tables[data_type],
+            itertools.izip(itertools.repeat(surface_id), group_ids.tolist(),
+            itertools.repeat(ecotope_id), taxon_ids.tolist(), sums.tolist(),
+            surfaces.tolist()))
+        cursor.close()
+
+    def group_surface(self, data_type, ecotope, group_id, surface_id=0):
+        """Return the surface of group `group_id` of ecotope `ecotope`."""
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT group_surface \
+            FROM %s \
+            WHERE surface_id = ? \
+            AND ecotope_id = ? \
+            AND group_id = ? \
+            LIMIT 1" % self._tables[data_type],
+            (surface_id, self._ecotope_ids[ecotope], group_id)
+            )
+        group_surface = cursor.fetchone()[0]
+        cursor.close()
+        return group_surface
+
+    def group_surfaces(self, data_type, ecotope, surface_id=0):
+        """Return the list of ``(group_id, group_surface)`` tuples for the
+        groups of ecotope `ecotope`, ordered by group ID.
+        """
+        if ecotope not in self._ecotope_ids:
+            return []
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT group_id, MIN(group_surface) \
+            FROM %s \
+            WHERE surface_id = ? \
+            AND ecotope_id = ? \
+            GROUP BY group_id \
+            ORDER BY group_id" % self._tables[data_type],
+            (surface_id, self._ecotope_ids[ecotope])
+            )
+        surfaces = cursor.fetchall()
+        cursor.close()
+        return surfaces
+
+    def taxon_sums(self, data_type, ecotope, surface_id=0):
+        """Return an iterator which generates a tuple ``(taxon_id,
+        group_id, sum)`` for each taxon in each group of ecotope `ecotope`,
+        ordered by taxon ID.
+
+        The sums are read in a single scan of the index on ecotope and
+        taxon.
+        """
+        if ecotope not in self._ecotope_ids:
+            return
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT taxon_id, group_id, sum_of \
+            FROM %s \
+            WHERE surface_id = ? \
+            AND ecotope_id = ? \
+            ORDER BY taxon_id, group_id" % self._tables[data_type],
+            (surface_id, self._ecotope_ids[ecotope])
+            )
+        for row in cursor:
+            yield row
+        cursor.close()
+
+    def selected_group_sums(self, data_type, groups, surface_id=0):
+        """Return an iterator which generates a tuple ``(taxon_id, ecotope,
+        sum)`` for each taxon in the groups of the list of ``(ecotope,
+        group_id)`` tuples `groups`, ordered by taxon ID.
+
+        The groups are put in a temporary table, so the sums of all groups
+        are read with a single query.
+        """
+        cursor = self.connect().cursor()
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS selected_groups ( \
+            ecotope_id INTEGER, \
+            group_id INTEGER \
+        )")
+        cursor.execute("DELETE FROM selected_groups")
+        cursor.executemany("INSERT INTO selected_groups VALUES (?,?)",
+            ((self._ecotope_ids[ecotope], group_id) for ecotope, group_id in
+            groups if ecotope in self._ecotope_ids))
+        cursor.execute("SELECT s.taxon_id, s.ecotope_id, s.sum_of \
+            FROM selected_groups g \
+            JOIN %s s ON s.surface_id = ? \
+                AND s.ecotope_id = g.ecotope_id \
+                AND s.group_id = g.group_id \
+            ORDER BY s.taxon_id" % self._tables[data_type],
+            (surface_id,)
+            )
+        for taxon_id, ecotope_id, sum_of in cursor:
+            yield (taxon_id, self._ecotopes[ecotope_id], sum_of)
+        cursor.close()
+
+    def group_cells(self, data_type, surface_id=0):
+        """Return the sums of all taxa in all groups as a tuple of arrays
+        ``(ecotope_ids, group_ids, sums)``.
+        """
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT ecotope_id, group_id, sum_of \
+            FROM %s \
+            WHERE surface_id = ?" % self._tables[data_type],
+            (surface_id,)
+            )
+        rows = cursor.fetchall()
+        cursor.close()
+        if rows:
+            ecotope_ids, group_ids, sums = zip(*rows)
+        else:
+            ecotope_ids = group_ids = sums = ()
+        return (np.array(ecotope_ids, dtype=np.intc),
+            np.array(group_ids, dtype=np.int_), np.array(sums, dtype=float))
+
+    def insert_diversities(self, ecotope, diversities, surface_id=0):
+        """Save the list of ``(group_id, diversity)`` tuples `diversities`
+        for ecotope `ecotope`.
+        """
+        ecotope_id = self._ecotope_ids[ecotope]
+        cursor = self.connect().cursor()
+        cursor.executemany("INSERT INTO biodiversity \
+            VALUES (null,?,?,?,?)",
+            ((surface_id, ecotope_id, group_id, diversity)
+            for group_id, diversity in diversities)
+            )
+        cursor.close()
+
+    def diversities(self, ecotope, surface_id=0):
+        """Return the list of ``(diversity, group_id)`` tuples for ecotope
+        `ecotope`.
+        """
+        if ecotope not in self._ecotope_ids:
+            return []
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT diversity, group_id \
+            FROM biodiversity \
+            WHERE surface_id = ? \
+            AND ecotope_id = ? \
+            ORDER BY id",
+            (surface_id, self._ecotope_ids[ecotope])
+            )
+        diversities = cursor.fetchall()
+        cursor.close()
+        return diversities
+
+class ArrayStore(Store):
+    """Keep the working data for the list of properties `properties` in
+    memory as NumPy arrays.
+
+    Each record is saved as a sample code, a taxon ID, an ecotope ID and a
+    value for each property. The values are held in an array with a column
+    for each property. The taxon and ecotope names are interned, so each
+    name is stored only once. If `float32` is True, the values are stored
+    as single precision floats, which saves another 4 bytes per value.
+    """
+
+    def __init__(self, properties, float32=False):
+        self._properties = list(properties)
+        self._value_type = 'f' if float32 else 'd'
+        self.create()
+
+    def close(self):
+        """Do nothing, as there is no file to close."""
+        pass
+
+    def create(self):
+        """Empty the store."""
+        # The columns are collected in compact arrays while loading.
+        self._columns = (array.array('l'), array.array('i'),
+            array.array('i'), array.array(self._value_type))
+        self.codes = self.taxon_ids = self.ecotope_ids = \
+            self.values = None
+
+        # The interned taxon and ecotope names.
+        self.reset_names()
+
+        self._surfaces = {}
+        self.clear_groups()
+
+    def clear_groups(self):
+        """Delete all sample groups and biodiversities, but keep the
+        data.
+        """
+        self._groups = {'raw': {}, 'normalized': {}}
+        self._diversities = {}
+
+    def insert(self, records, samples):
+        """Insert the list of records `records` and the list of
+        ``(sample_code, sample_surface)`` tuples `samples`.
+
+        A value of None is saved as NaN, which the store treats as no
+        value, like NULL in :class:`SQLiteStore`.
+        """
+        sample_codes, taxon_ids, ecotope_ids, values = self._columns
+        value_indexes = [3 if property == 'density' else 4 for property in
+            self._properties]
+        nan = float('nan')
+
+        for record in records:
+            sample_codes.append(record[0])
+            ecotope_ids.append(self._intern(record[1], self._ecotopes,
+                self._ecotope_ids))
+            taxon_ids.append(self._intern(record[2], self._taxa,
+                self._taxon_ids))
+            for i in value_indexes:
+                value = record[i]
+                values.append(nan if value is None else value)
+
+        self._surfaces.update(samples)
+
+    def commit(self):
+        """Do nothing, as there are no transactions."""
+        pass
+
+    def optimize(self):
+        """Convert the loaded columns to NumPy arrays and build the indexes
+        for the lookups.
+        """
+        if self._columns:
+            sample_codes, taxon_ids, ecotope_ids, values = self._columns
+            self.codes = np.frombuffer(sample_codes, dtype=np.int_)
+            self.taxon_ids = np.frombuffer(taxon_ids, dtype=np.intc)
+            self.ecotope_ids = np.frombuffer(ecotope_ids, dtype=np.intc)
+            self.values = np.frombuffer(values,
+                dtype=np.dtype(self._value_type)).reshape(-1,
+                len(self._properties))
+            self._columns = None
+
+            # Sum the records for the same sample, ecotope and taxon which
+            # were inserted by different batches.
+            self._aggregate()
+
+        self._build_indexes()
+
+    def _build_indexes(self):
+        """Build the indexes for the lookups."""
+        # Record indexes sorted by sample code, and by ecotope and taxon.
+        # Stable sorts keep the records in input order within a key.
+        self._by_sample = np.argsort(self.codes, kind='mergesort')
+        self._sorted_samples = self.codes[self._by_sample]
+        keys = self.ecotope_ids.astype(np.int64) * len(self._taxa) + \
+            self.taxon_ids
+        self._by_ecotope_taxon = np.argsort(keys, kind='mergesort')
+        self._sorted_ecotope_taxa = keys[self._by_ecotope_taxon]
+
+        # The sorted sample codes of each ecotope. The codes of ecotope ID
+        # i are self._ecotope_samples[ptr[i]:ptr[i+1]].
+        order = np.lexsort((self.codes, self.ecotope_ids))
+        ecotope_ids = self.ecotope_ids[order]
+        codes = self.codes[order]
+        first = np.concatenate(([True], (ecotope_ids[1:] != ecotope_ids[:-1]) |
+            (codes[1:] != codes[:-1]))) if len(codes) else \
+            np.zeros(0, dtype=bool)
+        self._ecotope_samples = codes[first]
+        self._ecotope_sample_ptr = np.searchsorted(ecotope_ids[first],
+            np.arange(len(self._ecotopes) + 1))
+
+    def saved_size(self):
+        """Return the estimated size in bytes of the file saved by
+        :meth:`save`. Only the records are counted.
+        """
+        return sum(column.nbytes for column in (self.codes, self.taxon_ids,
+            self.ecotope_ids, self.values))
+
+    def save(self, path):
+        """Save the data to file `path`."""
+        with open(path, 'wb') as f:
+            np.savez(f, codes=self.codes, taxon_ids=self.taxon_ids,
+                ecotope_ids=self.ecotope_ids, values=self.values,
+                taxa=np.array(self._taxa, dtype=object),
+                ecotopes=np.array(self._ecotopes, dtype=object),
+                sample_codes=np.array(self._surfaces.keys(), dtype=np.int_),
+                sample_surfaces=np.array(self._surfaces.values()))
+
+    def restore(self, path):
+        """Replace the contents of the store by the data in file `path`,
+        which was saved with :meth:`save`.
+        """
+        self.create()
+        self._columns = None
+
+        data = np.load(path, allow_pickle=True)
+        self.codes = data['codes']
+        self.taxon_ids = data['taxon_ids']
+        self.ecotope_ids = data['ecotope_ids']
+        self.values = data['values']
+        for taxon in data['taxa']:
+            self._intern(taxon, self._taxa, self._taxon_ids)
+        for ecotope in data['ecotopes']:
+            self._intern(ecotope, self._ecotopes, self._ecotope_ids)
+        self._surfaces = dict(zip(data['sample_codes'].tolist(),
+            data['sample_surfaces'].tolist()))
+        data.close()
+
+        self._build_indexes()
+
+    def save_groups(self, path):
+        """Save the sample groups and the biodiversities to file `path`,
+        without the data.
+        """
+        # The groups and the biodiversities are saved as rows of numbers.
+        # The groups are keyed by target surface ID and ecotope.
+        groups = {}
+        for data_type in self._groups:
+            rows = [np.column_stack((np.full(len(cells[0]), surface_id),
+                np.full(len(cells[0]), self._ecotope_ids[ecotope])) + cells)
+                for (surface_id, ecotope), cells in
+                ((key, matrix.cells()) for key, matrix in
+                self._groups[data_type].iteritems())]
+            groups[data_type] = np.concatenate(rows).astype(float) \
+                if rows else np.zeros((0, 6))
+        diversities = np.array([(surface_id, self._ecotope_ids[ecotope],
+            group_id, diversity) for (surface_id, ecotope) in
+            self._diversities for group_id, diversity in
+            self._diversities[(surface_id, ecotope)]],
+            dtype=float).reshape(-1, 4)
+
+        with open(path, 'wb') as f:
+            np.savez(f, raw_groups=groups['raw'],
+                normalized_groups=groups['normalized'],
+                diversities=diversities)
+
+    def restore_groups(self, path):
+        """Replace the sample groups and the biodiversities by those in
+        file `path`, which was saved with :meth:`save_groups`. The data
+        must be the same as when they were saved.
+        """
+        self.clear_groups()
+
+        data = np.load(path)
+        for data_type in self._groups:
+            rows = data['%s_groups' % data_type]
+            keys = rows[:,:2].astype(np.intc)
+            for surface_id, ecotope_id in set(map(tuple, keys.tolist())):
+                cells = rows[(keys[:,0] == surface_id) &
+                    (keys[:,1] == ecotope_id)]
+                self._groups[data_type][(surface_id,
+                    self._ecotopes[ecotope_id])] = GroupMatrix.from_cells(
+                    cells[:,2].astype(np.int_), cells[:,3].astype(np.intc),
+                    cells[:,4], cells[:,5])
+        for surface_id, ecotope_id, group_id, diversity in \
+                data['diversities'].tolist():
+            self._diversities.setdefault((int(surface_id),
+                self._ecotopes[int(ecotope_id)]), []).append(
+                (int(group_id), diversity) )
+        data.close()
+
+    def _aggregate(self):
+        """Sum the records with the same sample code, ecotope and taxon. The
+        records keep the order in which they first appear.
+        """
+        if len(self.codes) == 0:
+            return
+
+        # Stable sort by key, so the first record of each key comes first.
+        order = np.lexsort((self.taxon_ids, self.ecotope_ids, self.codes))
+        codes = self.codes[order]
+        ecotope_ids = self.ecotope_ids[order]
+        taxon_ids = self.taxon_ids[order]
+        starts = np.flatnonzero(np.concatenate(([True],
+            (codes[1:] != codes[:-1]) |
+            (ecotope_ids[1:] != ecotope_ids[:-1]) |
+            (taxon_ids[1:] != taxon_ids[:-1]))))
+        if len(starts) == len(order):
+            return
+
+        # Restore the input order of the first records. NaN counts as no
+        # value, so a sum is only NaN if all its values are.
+        first = np.argsort(order[starts], kind='mergesort')
+        values = self.values[order]
+        missing = np.isnan(values)
+        sums = np.add.reduceat(np.where(missing, 0, values), starts, axis=0)
+        sums[np.logical_and.reduceat(missing, starts, axis=0)] = np.nan
+        self.values = sums[first].astype(self.values.dtype)
+        self.codes = codes[starts][first]
+        self.ecotope_ids = ecotope_ids[starts][first]
+        self.taxon_ids = taxon_ids[starts][first]
+
+    def _column(self, property):
+        """Return the column of the values of property `property`."""
+        if property not in self._properties:
+            raise ValueError("The store holds values for %s, not '%s'." %
+                (" and ".join("'%s'" % x for x in self._properties),
+                property))
+        return self._properties.index(property)
+
+    def ecotope_sizes(self):
+        """Return a dictionary which maps each ecotope to a tuple
+        ``(samples, taxa, records)`` with the number of samples, taxa and
+        records for that ecotope.
+        """
+        n = len(self._ecotopes)
+        samples = distinct_counts(self.ecotope_ids, self.codes, n)
+        taxa = distinct_counts(self.ecotope_ids, self.taxon_ids, n)
+        records = np.bincount(self.ecotope_ids, minlength=n)
+        return dict(zip(self._ecotopes, zip(samples.tolist(), taxa.tolist(),
+            records.tolist())))
+
+    def sample_codes(self, ecotope):
+        """Return the sorted list of sample codes for ecotope `ecotope`."""
+        if ecotope not in self._ecotope_ids:
+            return []
+        return self._samples(ecotope).tolist()
+
+    def _samples(self, ecotope):
+        """Return the sorted array of sample codes for ecotope `ecotope`."""
+        ecotope_id = self._ecotope_ids[ecotope]
+        start, end = self._ecotope_sample_ptr[ecotope_id:ecotope_id+2]
+        return self._ecotope_samples[start:end]
+
+    def sample_records(self, ecotope, property):
+        """Return the records for property `property` of the samples in
+        ecotope `ecotope`, ordered by sample code.
+
+        The records are returned as a tuple of arrays ``(sample_codes,
+        sample_surfaces, taxon_ids, values)`` with one item per record. The
+        taxon IDs are indexes in the list returned by :meth:`taxa`.
+        """
+        column = self._column(property)
+        if ecotope not in self._ecotope_ids:
+            return record_arrays([])
+
+        # The records of each sample are a range in the sorted samples.
+        samples = self._samples(ecotope)
+        starts = np.searchsorted(self._sorted_samples, samples, side='left')
+        lengths = np.searchsorted(self._sorted_samples, samples,
+            side='right') - starts
+        offsets = np.cumsum(lengths) - lengths
+        index = self._by_sample[np.arange(lengths.sum()) +
+            np.repeat(starts - offsets, lengths)]
+        codes = self.codes[index]
+        surfaces = np.array([self._surfaces[x] for x in codes.tolist()],
+            dtype=float)
+        return (codes, surfaces, self.taxon_ids[index],
+            self.values[index, column].astype(float))
+
+    def records(self, property):
+        """Return all records for property `property` as a tuple of arrays
+        ``(sample_codes, ecotope_ids, taxon_ids, values)``.
+        """
+        column = self._column(property)
+        return (self.codes, self.ecotope_ids, self.taxon_ids,
+            self.values[:,column].astype(float))
+
+    def sample_surfaces(self):
+        """Return the sample codes and the sample surfaces of all samples
+        as a tuple of arrays ``(sample_codes, sample_surfaces)``.
+        """
+        return (np.array(self._surfaces.keys(), dtype=np.int_),
+            np.array(self._surfaces.values(), dtype=float))
+
+    def taxon_values(self, ecotope, property):
+        """Return an iterator which generates a tuple ``(taxon_id,
+        sample_code, value)`` with the value of property `property` for
+        each record of ecotope `ecotope`, ordered by taxon ID.
+        """
+        column = self._column(property)
+        if ecotope not in self._ecotope_ids:
+            return iter([])
+        key = self._ecotope_ids[ecotope] * len(self._taxa)
+        start = np.searchsorted(self._sorted_ecotope_taxa, key, side='left')
+        end = np.searchsorted(self._sorted_ecotope_taxa, key + len(self._taxa),
+            side='left')
+        index = self._by_ecotope_taxon[start:end]
+
+        # Return missing values as None, like the SQLite store does.
+        values = self.values[index, column]
+        missing = np.isnan(values)
+        values = values.tolist()
+        if missing.any():
+            for i in np.flatnonzero(missing).tolist():
+                values[i] = None
+        return itertools.izip(self.taxon_ids[index].tolist(),
+            self.codes[index].tolist(), values)
+
+    def insert_groups(self, data_type, ecotope, groups, surface_id=0):
+        """Save the sample groups of ecotope `ecotope` from
+        :class:`GroupMatrix` `groups`. Set `data_type` to "raw" or
+        "normalized" for the type of the groups, and `surface_id` to the
+        index of their target sample surface.
+        """
+        self._groups[data_type][(surface_id, ecotope)] = groups
+
+    def group_surface(self, data_type, ecotope, group_id, surface_id=0):
+        """Return the surface of group `group_id` of ecotope `ecotope`."""
+        groups = self._groups[data_type][(surface_id, ecotope)]
+        return float(groups.surfaces[group_id-1])
+
+    def group_surfaces(self, data_type, ecotope, surface_id=0):
+        """Return the list of ``(group_id, group_surface)`` tuples for the
+        groups of ecotope `ecotope`, ordered by group ID.
+        """
+        groups = self._groups[data_type].get((surface_id, ecotope))
+        if groups is None:
+            return []
+        return groups.group_surfaces()
+
+    def taxon_sums(self, data_type, ecotope, surface_id=0):
+        """Return an iterator which generates a tuple ``(taxon_id,
+        group_id, sum)`` for each taxon in each group of ecotope `ecotope`,
+        ordered by taxon ID.
+        """
+        groups = self._groups[data_type].get((surface_id, ecotope))
+        if groups is None:
+            return iter([])
+        return groups.taxon_sums()
+
+    def selected_group_sums(self, data_type, groups, surface_id=0):
+        """Return an iterator which generates a tuple ``(taxon_id, ecotope,
+        sum)`` for each taxon in the groups of the list of ``(ecotope,
+        group_id)`` tuples `groups`, ordered by taxon ID.
+        """
+        cells = []
+        for ecotope, group_id in groups:
+            matrix = self._groups[data_type].get((surface_id, ecotope))
+            if matrix is None:
+                continue
+            rows = np.flatnonzero(matrix.present[:,group_id-1])
+            cells.append((ecotope, matrix.taxon_ids[rows],
+                matrix.sums[rows, group_id-1]))
+        return selected_sums(cells)
+
+    def group_cells(self, data_type, surface_id=0):
+        """Return the sums of all taxa in all groups as a tuple of arrays
+        ``(ecotope_ids, group_ids, sums)``.
+        """
+        cells = [(np.full(len(group_ids), self._ecotope_ids[ecotope],
+            dtype=np.intc), group_ids, sums) for ecotope, (group_ids,
+            taxon_ids, sums, surfaces) in ((key[1], groups.cells()) for
+            key, groups in self._groups[data_type].iteritems()
+            if key[0] == surface_id)]
+        if not cells:
+            return (np.zeros(0, dtype=np.intc), np.zeros(0, dtype=np.int_),
+                np.zeros(0))
+        return tuple(np.concatenate(column) for column in zip(*cells))
+
+    def insert_diversities(self, ecotope, diversities, surface_id=0):
+        """Save the list of ``(group_id, diversity)`` tuples `diversities`
+        for ecotope `ecotope`.
+        """
+        self._diversities.setdefault((surface_id, ecotope),
+            []).extend(diversities)
+
+    def diversities(self, ecotope, surface_id=0):
+        """Return the list of ``(diversity, group_id)`` tuples for ecotope
+        `ecotope`.
+        """
+        return [(diversity, group_id) for group_id, diversity in
+            self._diversities.get((surface_id, ecotope), [])]
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010, 2011, 2015 GiMaRIS <info@gimaris.com>
+#
+#  This file is part of BioDen - A data normalizer and transponer for
+#  files containing taxon biomass/density data for ecotopes.
+#
+#  BioDen is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  BioDen is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+import bioden.store
+
+class StreamEngine(object):
+    """Hold the results of the stream engine for property `property`,
+    for the data in store `store`.
+
+    The stream engine groups, exports and scores one ecotope at a time
+    (see :meth:`bioden.processor.DataProcessor.stream`). The sample groups
+    of an ecotope are written to its files as soon as they are made, and
+    are not kept. Only the normalized representative group of each ecotope
+    is kept, for the representatives file.
+
+    The engine answers the queries of the generators of
+    :mod:`bioden.exporter` for the non-grouped data, which is read from
+    the store, and for the representative groups.
+    """
+
+    def __init__(self, store, property):
+        self._store = store
+        self._property = property
+        self._representatives = {}
+
+    def sample_surfaces(self):
+        """Return the sample codes and the sample surfaces of all samples
+        as a tuple of arrays ``(sample_codes, sample_surfaces)``.
+        """
+        return self._store.sample_surfaces()
+
+    def sample_codes(self, ecotope):
+        """Return the sample codes for ecotope `ecotope`."""
+        return self._store.sample_codes(ecotope)
+
+    def taxon_values(self, ecotope, property):
+        """Return an iterator which generates a tuple ``(taxon_id,
+        sample_code, value)`` with the value of property `property` for
+        each record of ecotope `ecotope`, ordered by taxon ID.
+        """
+        return self._store.taxon_values(ecotope, property)
+
+    def insert_representative(self, ecotope, group_id, groups, surface_id=0):
+        """Keep group `group_id` of the normalized sample groups `groups`
+        of ecotope `ecotope` as its representative group. Argument `groups`
+        is a :class:`bioden.store.GroupMatrix`, and `surface_id` is the
+        index of its target sample surface.
+
+        Only the taxa of the group are kept, so the matrix of the ecotope
+        can be freed.
+        """
+        column = group_id - 1
+        rows = np.flatnonzero(groups.present[:,column])
+        self._representatives[(surface_id, ecotope)] = (group_id,
+            float(groups.surfaces[column]), groups.taxon_ids[rows],
+            groups.sums[rows, column])
+
+    def representative(self, data_type, ecotope, group_id, surface_id=0):
+        """Return the kept representative group `group_id` of ecotope
+        `ecotope` as a tuple ``(group_id, group_surface, taxon_ids,
+        sums)``, or None if the ecotope has no groups.
+        """
+        group = self._representatives.get((surface_id, ecotope))
+        if data_type != 'normalized' or \
+                (group is not None and group[0] != group_id):
+            raise ValueError("The stream engine only keeps the normalized representative groups.")
+        return group
+
+    def group_surface(self, data_type, ecotope, group_id, surface_id=0):
+        """Return the surface of group `group_id` of ecotope `ecotope`."""
+        return self.representative(data_type, ecotope, group_id,
+            surface_id)[1]
+
+    def selected_group_sums(self, data_type, groups, surface_id=0):
+        """Return an iterator which generates a tuple ``(taxon_id, ecotope,
+        sum)`` for each taxon in the groups of the list of ``(ecotope,
+        group_id)`` tuples `groups`, ordered by taxon ID.
+        """
+        cells = []
+        for ecotope, group_id in groups:
+            group = self.representative(data_type, ecotope, group_id,
+                surface_id)
+            if group is not None:
+                cells.append((ecotope, group[2], group[3]))
+        return bioden.store.selected_sums(cells)
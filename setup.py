@@ -37,7 +37,9 @@ setup(
         'appdirs',
         'PyGObject>=3.2',
         'xlrd',
+        'openpyxl>=2.6',
         'xlwt',
+        'numpy',
     ],
     package_data={
         'bioden': [